@@ -0,0 +1,322 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Benchmark for ydiff on synthetic diffs
+
+Generates diffs of typical and adversarial shapes from a fixed seed, then
+measures input lines per second and peak memory (tracemalloc) of parsing, of
+rendering in each mode and theme and of finding changed words with each word
+diff engine, as well as time to the first screen of output.  Results are
+written as JSON so they can be compared across releases.
+"""
+
+import argparse
+import functools
+import itertools
+import json
+import os
+import platform
+import random
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..'))
+import ydiff  # nopep8
+
+_WORDS = ('self', 'return', 'value', 'index', 'None', 'import', 'config',
+          'if', 'for', 'in', 'data', 'result', '=', '+', '(', ')', ':', '0',
+          '1', 'error', 'path', 'line', 'width', 'True', 'append')
+_SCREEN = 24    # lines on the first screen
+_CJK = '差分比较工具彩色输出并排显示的文本宽度字符编码测试中文日本語한국어'
+
+
+def _code_line(rng, min_words=3, max_words=10, indent='    '):
+    words = rng.randint(min_words, max_words)
+    return indent * rng.randint(0, 3) + ' '.join(
+        rng.choice(_WORDS) for _ in range(words))
+
+
+def _cjk_line(rng):
+    return ''.join(rng.choice(_CJK + ' ') for _ in range(rng.randint(10, 60)))
+
+
+def _edit(rng, line):
+    """Returns line with a few words changed"""
+    words = line.split(' ')
+    for _ in range(rng.randint(1, 3)):
+        words[rng.randrange(len(words))] = rng.choice(_WORDS)
+    return ' '.join(words)
+
+
+def _file_diff(rng, path, hunks, hunk_size, make_line):
+    """Returns lines of a git diff of one file"""
+    out = ['diff --git a/%s b/%s' % (path, path),
+           'index 1234567..89abcde 100644',
+           '--- a/%s' % path,
+           '+++ b/%s' % path]
+    start = 1
+    for _ in range(hunks):
+        body, old_count, new_count = [], 0, 0
+        while old_count + new_count < hunk_size:
+            kind = rng.random()
+            line = make_line(rng)
+            if kind < 0.5:
+                body.append(' ' + line)
+                old_count += 1
+                new_count += 1
+            elif kind < 0.8:
+                body.append('-' + line)
+                body.append('+' + _edit(rng, line))
+                old_count += 1
+                new_count += 1
+            elif kind < 0.9:
+                body.append('-' + line)
+                old_count += 1
+            else:
+                body.append('+' + line)
+                new_count += 1
+        out.append('@@ -%d,%d +%d,%d @@ def func%d():' % (
+            start, old_count, start, new_count, start))
+        out.extend(body)
+        start += old_count + 20
+    return out
+
+
+def gen_many_small_files(rng, scale):
+    lines = []
+    for i in range(400 * scale):
+        lines.extend(_file_diff(rng, 'src/mod%d.py' % i, 1, 12, _code_line))
+    return lines
+
+
+def gen_huge_hunks(rng, scale):
+    lines = []
+    for i in range(2):
+        lines.extend(_file_diff(rng, 'data/huge%d.py' % i, 1, 2000 * scale,
+                                _code_line))
+    return lines
+
+
+def gen_many_hunks(rng, scale):
+    return _file_diff(rng, 'src/big.py', 1000 * scale, 12, _code_line)
+
+
+def gen_long_lines(rng, scale):
+    def make_line(rng):
+        return _code_line(rng, 40, 120, indent='')
+    lines = []
+    for i in range(5 * scale):
+        lines.extend(_file_diff(rng, 'min/bundle%d.js' % i, 2, 40, make_line))
+    return lines
+
+
+def gen_wide_chars(rng, scale):
+    lines = []
+    for i in range(50 * scale):
+        lines.extend(_file_diff(rng, 'doc/zh%d.txt' % i, 2, 30, _cjk_line))
+    return lines
+
+
+def gen_tabs(rng, scale):
+    def make_line(rng):
+        return _code_line(rng, indent='\t') + '\t# ' + rng.choice(_WORDS)
+    lines = []
+    for i in range(100 * scale):
+        lines.extend(_file_diff(rng, 'src/tab%d.c' % i, 2, 30, make_line))
+    return lines
+
+
+def gen_git_log(rng, scale):
+    lines = []
+    for i in range(100 * scale):
+        lines.extend([
+            'commit %040x' % rng.getrandbits(160),
+            'Author: Dev %d <dev%d@example.com>' % (i % 7, i % 7),
+            'Date:   Thu Jan 31 15:27:17 2013 +0800',
+            '',
+            '    Change number %d' % i,
+            '',
+        ])
+        for j in range(rng.randint(1, 4)):
+            lines.extend(_file_diff(rng, 'src/file%d.py' % j, 2, 16,
+                                    _code_line))
+    return lines
+
+
+WORKLOADS = {
+    'many-small-files': gen_many_small_files,
+    'huge-hunks': gen_huge_hunks,
+    'many-hunks': gen_many_hunks,
+    'long-lines': gen_long_lines,
+    'wide-chars': gen_wide_chars,
+    'tabs': gen_tabs,
+    'git-log': gen_git_log,
+}
+
+
+def _stages(themes):
+    """Yields (stage name, DiffMarker options), None options for parsing"""
+    yield 'parse', None
+    yield 'unified', dict(side_by_side=False)
+    yield 'side-by-side-wrap', dict(side_by_side=True, width=80, wrap=True)
+    yield 'side-by-side-nowrap', dict(side_by_side=True, width=80, wrap=False)
+    for theme in themes:
+        yield 'theme-%s' % theme, dict(side_by_side=True, width=80,
+                                       wrap=False, theme=theme)
+
+
+def _run(data, diffs, marker_opts):
+    if marker_opts is None:
+        for _ in ydiff.DiffParser(data).parse():
+            pass
+        return
+    marker = ydiff.DiffMarker(**marker_opts)
+    for diff in diffs:
+        for _ in marker.markup(diff):
+            pass
+
+
+def _changed_pairs(diffs):
+    """Returns (old, new) texts of all lines changed on both sides"""
+    return [(old[1], new[1]) for diff in diffs for hunk in diff._hunks
+            for old, new, changed in hunk.mdiff()
+            if changed and old[0] and new[0]]
+
+
+def _run_word_diff(pairs, engine):
+    for old, new in pairs:
+        ydiff._word_diff(old, new, engine)
+
+
+def _measure(fn, repeat):
+    """Returns (best seconds, peak bytes) of calling fn, memory is traced in
+    an extra run since tracemalloc slows things down"""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    tracemalloc.start()
+    try:
+        fn()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return best, peak
+
+
+def _first_screen(data, eager, repeat):
+    """Returns (best seconds, input lines read) until the first screen of
+    side-by-side output is rendered"""
+    best = None
+    for _ in range(repeat):
+        read = [0]
+
+        def reading():
+            for line in data:
+                read[0] += 1
+                yield line
+
+        start = time.perf_counter()
+        marker = ydiff.DiffMarker(side_by_side=True, width=80, wrap=False)
+        diffs = ydiff.DiffParser(reading()).parse(eager)
+        for _ in itertools.islice(
+                ydiff._markup_diffs(marker, diffs, '-\n'), _SCREEN):
+            pass
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, read[0]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        '--workload', action='append', choices=sorted(WORKLOADS),
+        help='workload to run, may be repeated (default: all)')
+    parser.add_argument(
+        '--stage', action='append', metavar='STAGE',
+        help='stage to run, may be repeated (default: all)')
+    parser.add_argument(
+        '--scale', type=int, default=1, metavar='N',
+        help='multiply size of generated diffs by N (default: 1)')
+    parser.add_argument(
+        '--repeat', type=int, default=3, metavar='N',
+        help='take best time of N runs (default: 3)')
+    parser.add_argument(
+        '--seed', type=int, default=0, metavar='N',
+        help='seed of the diff generators (default: 0)')
+    parser.add_argument(
+        '-o', '--output', metavar='FILE',
+        help='write JSON results to FILE instead of stdout')
+    opts = parser.parse_args()
+
+    # Builtin themes only, so results do not depend on user config
+    os.environ['XDG_CONFIG_HOME'] = os.devnull
+    themes = sorted(ydiff._all_themes())
+    results = []
+    for name in opts.workload or sorted(WORKLOADS):
+        rng = random.Random(opts.seed)
+        text = '\n'.join(WORKLOADS[name](rng, opts.scale)) + '\n'
+        data = [x.encode('utf-8') for x in text.splitlines(True)]
+        diffs = list(ydiff.DiffParser(data).parse())
+        runs = [(stage, functools.partial(_run, data, diffs, marker_opts))
+                for stage, marker_opts in _stages(themes)]
+        pairs = _changed_pairs(diffs)
+        runs.extend(('word-diff-%s' % engine,
+                     functools.partial(_run_word_diff, pairs, engine))
+                    for engine in sorted(ydiff._WORD_DIFF_ENGINES))
+        for stage, fn in runs:
+            if opts.stage and stage not in opts.stage:
+                continue
+            seconds, peak = _measure(fn, opts.repeat)
+            results.append({
+                'workload': name,
+                'stage': stage,
+                'lines': len(data),
+                'seconds': round(seconds, 6),
+                'lines_per_sec': round(len(data) / seconds),
+                'peak_memory': peak,
+            })
+            sys.stderr.write('%-18s %-24s %9d lines/s %9d KiB\n' % (
+                name, stage, results[-1]['lines_per_sec'], peak // 1024))
+        for stage, eager in (('first-screen', False),
+                             ('first-screen-low-latency', True)):
+            if opts.stage and stage not in opts.stage:
+                continue
+            seconds, lines = _first_screen(data, eager, opts.repeat)
+            results.append({
+                'workload': name,
+                'stage': stage,
+                'lines': lines,     # input lines read before first screen
+                'seconds': round(seconds, 6),
+                'lines_per_sec': None,
+                'peak_memory': None,
+            })
+            sys.stderr.write('%-18s %-24s %9.3f ms %9d lines read\n' % (
+                name, stage, seconds * 1000, lines))
+
+    report = {
+        'ydiff': ydiff.__version__,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'scale': opts.scale,
+        'seed': opts.seed,
+        'results': results,
+    }
+    if opts.output:
+        with open(opts.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+            f.write('\n')
+    else:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write('\n')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
+
+# vim:set et sts=4 sw=4 tw=79:
@@ -4,18 +4,38 @@
 """Unit test for ydiff"""
 
 from unittest import mock
+import argparse
+import contextlib
+import difflib
+import glob
 import io
+import itertools
+import json
 import os
+import pickle
 import re
 import subprocess
 import sys
 import tempfile
+import threading
+import time
 import unittest
 
 sys.path.insert(0, '')
 import ydiff  # nopep8
 
 
+def setUpModule():
+    # Keep cached data of tests away from user's cache
+    global _cache_home
+    _cache_home = tempfile.TemporaryDirectory()
+    os.environ['XDG_CACHE_HOME'] = _cache_home.name
+
+
+def tearDownModule():
+    _cache_home.cleanup()
+
+
 class SplitToWordsTest(unittest.TestCase):
 
     def test_ok(self):
@@ -37,6 +57,53 @@ class SplitToWordsTest(unittest.TestCase):
             self.assertEqual(want, got)
 
 
+class WordDiffTest(unittest.TestCase):
+
+    def test_engines(self):
+        tests = [
+            # (a, b, want)
+            ('import foo\n', 'import bar\n',
+             ('import \0^foo\1\n', 'import \0^bar\1\n')),
+            ('\0-same\1\n', '\0+same\1\n', ('same\n', 'same\n')),
+            ('i += 1\n', 'i += 10\n', ('i += \0^1\1\n', 'i += \0^10\1\n')),
+        ]
+        for engine in ['difflib', 'myers']:
+            for a, b, want in tests:
+                self.assertEqual(ydiff._word_diff(a, b, engine), want)
+
+    def test_myers_whitespace_only(self):
+        got = ydiff._word_diff('foo(a,b)  \n', 'foo(a, b)\n', 'myers')
+        self.assertEqual(got, ('foo(a,b)\0-  \1\n', 'foo(a,\0+ \1b)\n'))
+
+    def test_myers_minimal(self):
+        old = ydiff._split_to_words('a b c a b b a')
+        new = ydiff._split_to_words('c b a b a c')
+        matched = sum(i2 - i1 for tag, i1, i2, _, _ in
+                      ydiff._myers_opcodes(old, new) if tag == 'equal')
+        self.assertEqual(matched, 8)    # length of LCS
+
+    @mock.patch('ydiff._MYERS_MAX_EDITS', 2)
+    def test_myers_too_many_edits(self):
+        got = ydiff._myers_opcodes(list('abcd'), list('xyzw'))
+        self.assertEqual(got, [('replace', 0, 4, 0, 4)])
+
+
+class PaletteTest(unittest.TestCase):
+
+    def test_colorize(self):
+        palette = ydiff._Palette('default')
+        self.assertEqual(palette.colorize('foo', 'header'),
+                         '\x1b[36mfoo\x1b[0m')
+        self.assertEqual(
+            palette.colorize('a\0-b\1c\0^d\1', 'replaced_old_text'),
+            '\x1b[31ma\x1b[7m\x1b[31mb\x1b[0m\x1b[31m'
+            'c\x1b[7m\x1b[31md\x1b[0m\x1b[31m\x1b[0m')
+        self.assertEqual(
+            palette.colorize('\0+b\1', 'replaced_new_text'),
+            '\x1b[32m\x1b[7m\x1b[32mb\x1b[0m\x1b[32m\x1b[0m')
+        self.assertIn('\x1b[7m', palette.codes)
+
+
 class StrSplitTest(unittest.TestCase):
 
     def test_not_colorized(self):
@@ -78,6 +145,39 @@ class StrSplitTest(unittest.TestCase):
             self.assertEqual(want_width, got[2])
 
 
+class StrWrapTest(unittest.TestCase):
+
+    def test_empty(self):
+        self.assertEqual([], list(ydiff._strwrap('', 4, {})))
+
+    def test_colorized(self):
+        g = '\x1b[32m'  # green
+        b = '\x1b[34m'  # blue
+        r = '\x1b[0m'   # reset
+        parts = [g, 'H', 'i', r, b, '!', r, '你', '好']
+        codes = {g, b, r}
+        got = list(ydiff._strwrap(''.join(parts), 2, codes))
+        want = [
+            (''.join([g, 'Hi', r, b, r]), 2),
+            (''.join([b, '!', r, '你']), 3),
+            ('好', 2),
+        ]
+        self.assertEqual(want, got)
+
+    def test_same_as_strsplit(self):
+        g = '\x1b[32m'  # green
+        r = '\x1b[0m'   # reset
+        text = 'ab%scd 你好%sx\tyz%s%s中文' % (g, r, g, 'w' * 20)
+        for width in range(1, 12):
+            want = []
+            left = text
+            while left:
+                piece, left, piece_width = ydiff._strsplit(left, width, {g, r})
+                want.append((piece, piece_width))
+            got = list(ydiff._strwrap(text, width, {g, r}))
+            self.assertEqual(want, got, 'width %d failed' % width)
+
+
 class StrTrimTest(unittest.TestCase):
 
     def test_not_colorized(self):
@@ -131,22 +231,267 @@ class DecodeTest(unittest.TestCase):
         self.assertEqual(ydiff._decode(octets), want)
 
 
+class MappedFileTest(unittest.TestCase):
+
+    def _lines(self, data, offset=0):
+        with tempfile.TemporaryFile() as f:
+            f.write(data)
+            f.seek(offset)
+            mapped = ydiff._MappedFile(f)
+            lines = list(mapped)
+            mapped.close()
+        return lines
+
+    def test_lines(self):
+        data = b'foo\n\nbar\r\nx\ry\n\xe4\xbd\xa0\nno newline'
+        self.assertEqual(self._lines(data), io.BytesIO(data).readlines())
+
+    @mock.patch('ydiff._MMAP_CHUNK', 4)
+    def test_chunks(self):
+        for data in (b'a\n' * 5, b'abcdefg\nh\n\n', b'a\rbcdefgh\ri',
+                     b'\n\n\n\n\n'):
+            self.assertEqual(self._lines(data), io.BytesIO(data).readlines())
+
+    def test_offset(self):
+        self.assertEqual(self._lines(b'skip\nfoo\nbar\n', 5),
+                         [b'foo\n', b'bar\n'])
+
+
+class PatchIndexTest(unittest.TestCase):
+
+    patch = b"""\
+commit 1
+diff --git a/foo b/foo
+--- a/foo
++++ b/foo
+@@ -1,2 +1,2 @@
+--- not a path
++++ not a path
+ common
+\\ No newline at end of file
+extra header
+@@ -10 +10 @@ func
+-x
++y
+diff --git a/bin b/bin
+Binary files a/bin and b/bin differ
+------------------------------------------------------------------------
+r1 | svn log separator
+--- bar\t(revision 1)
++++ bar\t(working copy)
+@@ -1 +1 @@
+-a
++b
+"""
+
+    def _index(self):
+        self._file = tempfile.TemporaryFile()
+        self._file.write(self.patch)
+        self._file.seek(0)
+        self.addCleanup(self._file.close)
+        mapped = ydiff._MappedFile(self._file)
+        self.addCleanup(mapped.close)
+        return mapped, ydiff._PatchIndex.load(mapped)
+
+    def _lines(self, mapped, index, selection):
+        return [line for start, end in index.ranges(selection)
+                for line in mapped.lines(start, end)]
+
+    def test_scan(self):
+        mapped, index = self._index()
+        self.assertEqual([x[1] for x in index.files],
+                         [b'b/foo', b'bin', b'bar'])
+        lines = self.patch.splitlines(True)
+        offsets = [0]
+        for line in lines:
+            offsets.append(offsets[-1] + len(line))
+        self.assertEqual(index.files, [
+            [0, b'b/foo', [offsets[4], offsets[9]]],
+            [offsets[13], b'bin', []],
+            [offsets[15], b'bar', [offsets[19]]],
+        ])
+        self.assertEqual(index.end, len(self.patch))
+
+    def test_scan_deleted_file(self):
+        patch = (b'--- a/gone\n+++ /dev/null\n@@ -1 +0,0 @@\n-x\n'
+                 b'--- /dev/null\n+++ b/new\n@@ -0,0 +1 @@\n+y\n')
+        index = ydiff._PatchIndex.scan(patch.splitlines(True))
+        self.assertEqual([x[1] for x in index.files], [b'a/gone', b'b/new'])
+
+    def test_scan_no_paths(self):
+        patch = (b'diff --git a/x b/x\nold mode 100755\nnew mode 100644\n'
+                 b'Only in a: y\nIndex: z\nsvn:mime-type = text/plain\n')
+        index = ydiff._PatchIndex.scan(patch.splitlines(True))
+        self.assertEqual(index.files, [
+            [0, b'x', []], [51, b'a/y', []], [64, b'z', []]])
+
+    @staticmethod
+    def _parsed(lines):
+        """Returns lines of diffs parsed, and hunk lists of each diff"""
+        diffs = list(ydiff.DiffParser(lines).parse())
+        flat = []
+        for diff in diffs:
+            flat.extend(diff._headers)
+            flat.extend(x for x in (diff._old_path, diff._new_path) if x)
+            for hunk in diff._hunks:
+                flat.extend(hunk._hunk_headers)
+                flat.append(hunk._hunk_meta)
+                flat.extend(hunk._hunk_list)
+        return flat, [[x._hunk_list for x in diff._hunks]
+                      for diff in diffs if diff._hunks]
+
+    def test_same_diffs_as_parser(self):
+        tests = os.path.dirname(os.path.abspath(__file__))
+        patches = [self.patch]
+        for name in ('git-perm', 'svn-property'):
+            with open(os.path.join(tests, name, 'in.diff'), 'rb') as f:
+                patches.append(f.read())
+        for patch in patches:
+            index = ydiff._PatchIndex.scan(patch.splitlines(True))
+            self.assertTrue(index.files)
+            flat, hunks = [], []
+            for start, end in index.ranges([(1, None, None)]):
+                file_flat, file_hunks = self._parsed(
+                    patch[start:end].splitlines(True))
+                self.assertLessEqual(len(file_hunks), 1)
+                flat.extend(file_flat)
+                hunks.extend(file_hunks)
+            self.assertEqual((flat, hunks),
+                             self._parsed(patch.splitlines(True)))
+
+    def test_select(self):
+        mapped, index = self._index()
+        lines = self.patch.splitlines(True)
+        self.assertEqual(self._lines(mapped, index, [(1, None, None)]),
+                         lines)
+        self.assertEqual(self._lines(mapped, index, [(2, 5, None)]),
+                         lines[13:])
+        self.assertEqual(self._lines(mapped, index, [(2, 2, None)]),
+                         lines[13:15])
+        self.assertEqual(self._lines(mapped, index, [(1, 1, 2)]),
+                         lines[:4] + lines[9:13])
+        self.assertEqual(self._lines(mapped, index, [(1, 1, 3), (4, 5, None),
+                                                     (2, 2, 1)]),
+                         [])
+
+    def test_cached(self):
+        mapped, index = self._index()
+        with mock.patch('ydiff._PatchIndex.scan') as m_scan:
+            cached = ydiff._PatchIndex.load(mapped)
+        self.assertFalse(m_scan.called)
+        self.assertEqual((cached.files, cached.end), (index.files, index.end))
+
+    def test_file_selection(self):
+        self.assertEqual(ydiff._file_selection('3, 2-5,7-,3:2'), [
+            (3, 3, None), (2, 5, None), (7, None, None), (3, 3, 2)])
+        for spec in ('0', 'a', '1:0', '-3', '1-2:3', ''):
+            self.assertRaises(argparse.ArgumentTypeError,
+                              ydiff._file_selection, spec)
+
+
 class HunkTest(unittest.TestCase):
 
     def test_get_old(self):
         hunk = ydiff.Hunk([], '@@ -1,2 +1,2 @@', (1, 2), (1, 2))
-        hunk.append(('-', 'foo\n'))
-        hunk.append(('+', 'bar\n'))
-        hunk.append((' ', 'common\n'))
+        hunk.append('-foo\n')
+        hunk.append('+bar\n')
+        hunk.append(' common\n')
         self.assertEqual(hunk._get_old(), ['foo\n', 'common\n'])
 
     def test_get_new(self):
         hunk = ydiff.Hunk([], '@@ -1,2 +1,2 @@', (1, 2), (1, 2))
-        hunk.append(('-', 'foo\n'))
-        hunk.append(('+', 'bar\n'))
-        hunk.append((' ', 'common\n'))
+        hunk.append('-foo\n')
+        hunk.append('+bar\n')
+        hunk.append(' common\n')
         self.assertEqual(hunk._get_new(), ['bar\n', 'common\n'])
 
+    def test_views_and_completion(self):
+        hunk = ydiff.Hunk([], '@@ -1,2 +1,1 @@', (1, 2), (1, 1))
+        hunk.append('-foo\n')
+        self.assertFalse(hunk.is_completed())
+        hunk.append(' common\n')
+        self.assertTrue(hunk.is_completed())
+        self.assertEqual(len(hunk.old_lines()), 2)
+        self.assertEqual(len(hunk.new_lines()), 1)
+        self.assertEqual(list(hunk.new_lines()), ['common\n'])
+
+
+class PairLinesTest(unittest.TestCase):
+
+    def _strip(self, rows):
+        """Removes intraline markers from rows changed on both sides"""
+        def strip(line):
+            return line[0], re.sub('\0[-+^]|\1', '', line[1])
+        return [(strip(a), strip(b), c) if a[0] and b[0] and c else (a, b, c)
+                for a, b, c in rows]
+
+    def test_same_as_difflib(self):
+        tests = [
+            # (old, new)
+            (['a\n', 'b\n'], ['a\n', 'b\n']),
+            (['_hello\n', 'world\n', 'garb\n', 'Again\n', '\ttabbed\n'],
+             ['hello+\n', 'spammm\n', 'world\n', 'again\n', ' spaced\n']),
+            (['import foo\n', 'x\n', 'y\n'], ['import bar\n', 'z\n']),
+            (['a\n', 'b\n', 'c\n'], ['d\n']),
+            (['a\n'], ['b\n', 'c\n', 'd\n', 'a\n']),
+            (['one\n', 'two\n', 'three\n'], ['ore\n', 'tree\n', 'emu\n']),
+            (['foo\n', ''], ['foo\n']),
+        ]
+        for old, new in tests:
+            self.assertEqual(self._strip(difflib._mdiff(old, new)),
+                             self._strip(ydiff._pair_lines(old, new)))
+
+    def test_pure_add_and_delete(self):
+        self.assertEqual(list(ydiff._pair_lines([], ['a\n', ''])), [
+            (('', '\n'), (1, '\0+a\n\1'), True),
+            (('', '\n'), (2, '\0+ \1'), True),
+        ])
+        self.assertEqual(list(ydiff._pair_lines(['a\n'], [])), [
+            ((1, '\0-a\n\1'), ('', '\n'), True),
+        ])
+
+    @mock.patch('ydiff._PAIRING_BUDGET', 1)
+    def test_budget_exceeded(self):
+        old = ['spam\n', 'foo\n', 'eggs\n']
+        new = ['foo!\n', 'ham\n']
+        self.assertEqual(list(ydiff._pair_lines(old, new)), [
+            ((1, '\0-spam\n\1'), (1, '\0+foo!\n\1'), True),
+            ((2, '\0-foo\n\1'), (2, '\0+ham\n\1'), True),
+            ((3, '\0-eggs\n\1'), ('', '\n'), True),
+        ])
+
+    def test_pair_in_order(self):
+        lines = [' a\n', '-b\n', '-c\n', '+d\n', '-e\n', '+f\n', '+g\n']
+        self.assertEqual(list(ydiff._pair_in_order(lines)), [
+            ((1, 'a\n'), (1, 'a\n'), False),
+            ((2, '\0-b\n\1'), (2, '\0+d\n\1'), True),
+            ((3, '\0-c\n\1'), ('', '\n'), True),
+            ((4, '\0-e\n\1'), (3, '\0+f\n\1'), True),
+            (('', '\n'), (4, '\0+g\n\1'), True),
+        ])
+
+
+class PathFilterTest(unittest.TestCase):
+
+    def test_skipped(self):
+        path_filter = ydiff._PathFilter(include=['*.py', 'docs/*'],
+                                        exclude=['*_pb2.py', 'docs/gen/*'])
+        self.assertFalse(path_filter.skipped(['src/foo.py']))
+        self.assertFalse(path_filter.skipped(['a/docs/index.rst']))
+        self.assertTrue(path_filter.skipped(['README']))
+        self.assertTrue(path_filter.skipped(['src/foo_pb2.py']))
+        self.assertTrue(path_filter.skipped(['docs/gen/api.rst']))
+        self.assertFalse(path_filter.skipped(['foo_pb2.py', 'foo.py']))
+        self.assertFalse(path_filter.skipped([]))
+
+    def test_diff_paths(self):
+        diff = ydiff.UnifiedDiff(['diff --git a/old b/new\n'],
+                                 '--- a/old\n', '+++ b/new\n', [])
+        self.assertEqual(ydiff._diff_paths(diff), ['new', 'old'])
+        diff = ydiff.UnifiedDiff([], '--- /dev/null\n',
+                                 '+++ foo\t(working copy)\n', [])
+        self.assertEqual(ydiff._diff_paths(diff), ['foo'])
+
 
 class DiffMarkupTest(unittest.TestCase):
 
@@ -170,15 +515,15 @@ class DiffMarkupTest(unittest.TestCase):
 
         hunk = ydiff.Hunk(['hunk header\n'], '@@ -1,5 +1,5 @@\n',
                           (1, 5), (1, 5))
-        hunk.append(('-', '_hello\n'))
-        hunk.append(('+', 'hello+\n'))
-        hunk.append(('+', 'spammm\n'))
-        hunk.append((' ', 'world\n'))
-        hunk.append(('-', 'garb\n'))
-        hunk.append(('-', 'Again\n'))
-        hunk.append(('-', '\ttabbed\n'))
-        hunk.append(('+', 'again\n'))
-        hunk.append(('+', ' spaced\n'))
+        hunk.append('-_hello\n')
+        hunk.append('+hello+\n')
+        hunk.append('+spammm\n')
+        hunk.append(' world\n')
+        hunk.append('-garb\n')
+        hunk.append('-Again\n')
+        hunk.append('-\ttabbed\n')
+        hunk.append('+again\n')
+        hunk.append('+ spaced\n')
         diff = ydiff.UnifiedDiff(
             ['header\n'], '--- old\n', '+++ new\n', [hunk])
         return diff
@@ -198,7 +543,7 @@ class DiffMarkupTest(unittest.TestCase):
 
     def test_markup_traditional_old_changed(self):
         hunk = ydiff.Hunk([], '@@ -1 +0,0 @@\n', (1, 0), (0, 0))
-        hunk.append(('-', 'spam\n'))
+        hunk.append('-spam\n')
         diff = ydiff.UnifiedDiff([], '--- old\n', '+++ new\n', [hunk])
         marker = ydiff.DiffMarker()
 
@@ -212,7 +557,7 @@ class DiffMarkupTest(unittest.TestCase):
 
     def test_markup_traditional_new_changed(self):
         hunk = ydiff.Hunk([], '@@ -0,0 +1 @@\n', (0, 0), (1, 0))
-        hunk.append(('+', 'spam\n'))
+        hunk.append('+spam\n')
         diff = ydiff.UnifiedDiff([], '--- old\n', '+++ new\n', [hunk])
         marker = ydiff.DiffMarker()
 
@@ -224,11 +569,88 @@ class DiffMarkupTest(unittest.TestCase):
         self.assertEqual(out[2], '\x1b[34m@@ -0,0 +1 @@\n\x1b[0m')
         self.assertEqual(out[3], '\x1b[32m+spam\n\x1b[0m')
 
+    def test_markup_max_intraline_lines(self):
+        diff = self._init_diff()
+        marker = ydiff.DiffMarker(max_intraline_lines=8)
+
+        out = list(marker.markup(diff))
+        self.assertEqual(len(out), 15)
+        self.assertEqual(out[5], '\x1b[95mydiff: hunk has more than 8 lines, '
+                         'changed words not highlighted\n\x1b[0m')
+        self.assertEqual(out[6], '\x1b[31m-_hello\n\x1b[0m')
+        self.assertEqual(out[7], '\x1b[32m+hello+\n\x1b[0m')
+        self.assertEqual(out[9], '\x1b[0m world\n\x1b[0m')
+
+    def test_markup_side_by_side_max_intraline_lines(self):
+        diff = self._init_diff()
+        marker = ydiff.DiffMarker(side_by_side=True, width=7, wrap=False,
+                                  max_intraline_lines=8)
+
+        out = list(marker.markup(diff))
+        self.assertEqual(len(out), 12)
+        self.assertIn('hunk has more than 8 lines', out[5])
+        self.assertEqual(
+            out[6],
+            '\x1b[33m1\x1b[0m \x1b[31m_hello\x1b[0m  \x1b[0m'
+            '\x1b[33m1\x1b[0m \x1b[32mhello+\x1b[0m\n')
+        self.assertEqual(
+            out[9],
+            '\x1b[33m3\x1b[0m \x1b[31mgarb\x1b[0m    \x1b[0m'
+            '\x1b[33m4\x1b[0m \x1b[32magain\x1b[0m\n')
+
+    @mock.patch('ydiff._WORD_MEMO_SIZE', 2)
+    def test_word_diff_memo(self):
+        marker = ydiff.DiffMarker()
+        want = ydiff._word_diff('foo', 'bar')
+        with mock.patch('ydiff._word_diff', wraps=ydiff._word_diff) as m_diff:
+            self.assertEqual(marker._diff_words('foo', 'bar'), want)
+            marker._diff_words('a', 'b')
+            self.assertEqual(marker._diff_words('foo', 'bar'), want)
+            self.assertEqual(m_diff.call_count, 2)
+
+            # Least recently used pair is evicted
+            marker._diff_words('c', 'd')
+            marker._diff_words('foo', 'bar')
+            self.assertEqual(m_diff.call_count, 3)
+            marker._diff_words('a', 'b')
+            self.assertEqual(m_diff.call_count, 4)
+
+    def test_markup_render_budget(self):
+        diff = self._init_diff()
+        marker = ydiff.DiffMarker(side_by_side=True, render_budget_ms=1)
+
+        # Every clock reading is one second later
+        with mock.patch('time.monotonic', side_effect=itertools.count()):
+            out = list(marker.markup(diff))
+        self.assertEqual(len(out), 15)
+        self.assertEqual(out[5], '\x1b[95mydiff: render budget of 1ms '
+                         'exceeded, hunks not colorized from here on'
+                         '\n\x1b[0m')
+        self.assertEqual(out[6:], diff._hunks[0]._hunk_list)
+
+        # Notice is only output once
+        with mock.patch('time.monotonic', side_effect=itertools.count()):
+            out = list(marker.markup(diff))
+        self.assertEqual(len(out), 14)
+
+    def test_markup_render_budget_slow_input(self):
+        marker = ydiff.DiffMarker(render_budget_ms=200)
+        clock = [0]
+
+        def events():
+            for _ in range(3):
+                yield from self._init_diff().events()
+                clock[0] += 1     # waiting for input takes one second
+
+        with mock.patch('time.monotonic', side_effect=lambda: clock[0]):
+            out = list(marker.markup_events(events()))
+        self.assertFalse([x for x in out if 'render budget' in x])
+
     def test_markup_traditional_both_changed(self):
         hunk = ydiff.Hunk([], '@@ -1,2 +1,2 @@\n', (1, 2), (1, 2))
-        hunk.append(('-', 'hell-\n'))
-        hunk.append(('+', 'hell+\n'))
-        hunk.append((' ', 'common\n'))
+        hunk.append('-hell-\n')
+        hunk.append('+hell+\n')
+        hunk.append(' common\n')
         diff = ydiff.UnifiedDiff([], '--- old\n', '+++ new\n', [hunk])
         marker = ydiff.DiffMarker()
 
@@ -356,8 +778,8 @@ class DiffMarkupTest(unittest.TestCase):
     def test_markup_side_by_side_wrap_true(self):
         hunk = ydiff.Hunk([], '@@ -1 +1 @@\n', (1, 1), (1, 1))
         # Create lines longer than width (width=5)
-        hunk.append(('-', '1234567890\n'))
-        hunk.append(('+', 'abcdefghij\n'))
+        hunk.append('-1234567890\n')
+        hunk.append('+abcdefghij\n')
         diff = ydiff.UnifiedDiff([], '--- a', '+++ b', [hunk])
         marker = ydiff.DiffMarker(side_by_side=True, width=5, wrap=True)
 
@@ -384,8 +806,8 @@ class DiffMarkupTest(unittest.TestCase):
 
     def test_markup_side_by_side_pad(self):
         hunk = ydiff.Hunk([], '@@ -1 +1 @@\n', (1, 1), (1, 1))
-        hunk.append(('-', '123456\n'))
-        hunk.append(('+', 'abcdef\n'))
+        hunk.append('-123456\n')
+        hunk.append('+abcdef\n')
         diff = ydiff.UnifiedDiff([], '--- a', '+++ b', [hunk])
         marker = ydiff.DiffMarker(side_by_side=True, width=5, wrap=True)
         out = list(marker.markup(diff))
@@ -461,6 +883,194 @@ class UnifiedDiffTest(unittest.TestCase):
 
 class DiffParserTest(unittest.TestCase):
 
+    def test_parse_eager(self):
+        patch = b"""\
+--- a
++++ b
+@@ -1,2 +1,2 @@
+-foo
++bar
+ common
+@@ -10 +10 @@
+-spam
++eggs
+@@ -20 +20 @@
+-x
++y
+--- c
++++ c
+@@ -1 +1 @@
+-c
++d
+"""
+        items = patch.splitlines(True)
+
+        def stream():
+            # First hunk is ready before the third one is read
+            yield from items[:8]
+            self.assertEqual(len(out), 1)
+            yield from items[8:]
+
+        out = []
+        for diff in ydiff.DiffParser(stream()).parse(eager=True):
+            out.append(diff)
+        self.assertEqual(len(out), 4)
+        self.assertEqual(out[0]._old_path, '--- a\n')
+        self.assertEqual([x._hunk_meta for x in out[0]._hunks],
+                         ['@@ -1,2 +1,2 @@\n'])
+        self.assertIsNone(out[1]._old_path)
+        self.assertEqual(out[1]._headers, [])
+        self.assertEqual([x._hunk_meta for x in out[1]._hunks],
+                         ['@@ -10 +10 @@\n'])
+        self.assertIsNone(out[2]._old_path)
+        self.assertEqual([x._hunk_meta for x in out[2]._hunks],
+                         ['@@ -20 +20 @@\n'])
+        self.assertEqual(out[3]._old_path, '--- c\n')
+        self.assertEqual(len(out[3]._hunks), 1)
+
+    def test_parse_counted(self):
+        patch = b"""\
+--- a
++++ b
+@@ -1,4 +1,2 @@
+ common
+--- a
+------------------------------------------------------------------------
+\\ No newline at end of file
++++ b
+-foo
+------------------------------------------------------------------------
+r1 | me | 2013-01-31
+"""
+        items = patch.splitlines(True)
+        out = list(ydiff.DiffParser(iter(items)).parse())
+        self.assertEqual(len(out), 2)
+        self.assertEqual(out[0]._hunks[0]._hunk_list,
+                         [x.decode() for x in items[3:6] + items[7:9]])
+        self.assertEqual(out[1]._headers,
+                         [x.decode() for x in items[9:]])
+
+        # Heuristics take the line of dashes as svn log separator anywhere
+        out = list(ydiff.DiffParser(iter(items), counted=False).parse())
+        self.assertNotIn(items[5].decode(), out[0]._hunks[0]._hunk_list)
+
+    def test_parse_counted_same_as_heuristic(self):
+        top = os.path.dirname(os.path.abspath(__file__))
+        for path in sorted(glob.glob(os.path.join(top, '*', '*.diff'))):
+            with open(path, 'rb') as f:
+                items = f.readlines()
+            for eager in (False, True):
+                want = [(x._headers, x._old_path, x._new_path,
+                         [(h._hunk_meta, h._hunk_list) for h in x._hunks])
+                        for x in ydiff.DiffParser(
+                            items, counted=False).parse(eager)]
+                got = [(x._headers, x._old_path, x._new_path,
+                        [(h._hunk_meta, h._hunk_list) for h in x._hunks])
+                       for x in ydiff.DiffParser(items).parse(eager)]
+                self.assertEqual(got, want, path)
+
+    def test_events(self):
+        patch = b"""\
+--- a
++++ b
+@@ -1 +1 @@
+-foo
++bar
+@@ -10 +10 @@
+-spam
++eggs
+Only in foo: bar
+"""
+        items = patch.splitlines(True)
+        events = list(ydiff.DiffParser(iter(items)).events())
+        self.assertEqual([x[0] for x in events], [
+            ydiff.EVENT_FILE, ydiff.EVENT_HUNK, ydiff.EVENT_HUNK,
+            ydiff.EVENT_END, ydiff.EVENT_FILE, ydiff.EVENT_END])
+        diff = events[0][1]
+        self.assertEqual(diff._old_path, '--- a\n')
+        self.assertEqual(diff._hunks, [])
+        self.assertIs(events[3][1], diff)
+        self.assertEqual([x[1]._hunk_meta for x in events[1:3]],
+                         ['@@ -1 +1 @@\n', '@@ -10 +10 @@\n'])
+        self.assertEqual(events[4][1]._headers, ['Only in foo: bar\n'])
+
+    def test_path_filter(self):
+        patch = b"""\
+commit 1
+
+    message
+diff --git a/vendor/lib.go b/vendor/lib.go
+--- a/vendor/lib.go
++++ b/vendor/lib.go
+@@ -1,2 +1,2 @@
+--- not a path
++++ not a path
+ common
+\\ No newline at end of file
+hunk header
+@@ -10 +10 @@
+-x
++y
+diff --git a/src/main.go b/src/main.go
+--- a/src/main.go
++++ b/src/main.go
+@@ -1 +1 @@
+-foo
++bar
+diff --git a/vendor/logo.png b/vendor/logo.png
+Binary files a/vendor/logo.png and b/vendor/logo.png differ
+"""
+        items = patch.splitlines(True)
+        decoded = []
+        with mock.patch('ydiff._decode',
+                        side_effect=lambda x: decoded.append(x) or
+                        x.decode('utf-8')):
+            diffs = list(ydiff.DiffParser(
+                iter(items),
+                path_filter=ydiff._PathFilter(exclude=['vendor/*'])).parse())
+        self.assertEqual([x._headers for x in diffs], [
+            ['commit 1\n', '\n', '    message\n'],
+            ['diff --git a/src/main.go b/src/main.go\n'],
+        ])
+        self.assertEqual(diffs[1]._new_path, '+++ b/src/main.go\n')
+        self.assertEqual(diffs[1]._hunks[0]._hunk_list, ['-foo\n', '+bar\n'])
+        self.assertNotIn(b'-x\n', decoded)
+        self.assertNotIn(b'--- not a path\n', decoded)
+
+        diffs = list(ydiff.DiffParser(
+            iter(items), path_filter=ydiff._PathFilter(
+                include=['*.go'], summary=True)).parse())
+        self.assertEqual(len(diffs), 3)
+        self.assertEqual(diffs[2]._headers,
+                         ['ydiff: skipped vendor/logo.png\n'])
+
+    def test_path_filter_last_diff(self):
+        patch = b"""\
+diff --git a/a.py b/a.py
+--- a/a.py
++++ b/a.py
+@@ -1 +1 @@
+-foo
++bar
+diff --git a/b.lock b/b.lock
+--- a/b.lock
++++ b/b.lock
+@@ -1 +1 @@
+-spam
++eggs
+"""
+        for summary in (False, True):
+            path_filter = ydiff._PathFilter(exclude=['*.lock'],
+                                            summary=summary)
+            diffs = list(ydiff.DiffParser(
+                iter(patch.splitlines(True)),
+                path_filter=path_filter).parse())
+            self.assertEqual([x._new_path for x in diffs],
+                             ['+++ b/a.py\n'] + [''] * summary)
+            if summary:
+                self.assertEqual(diffs[1]._headers,
+                                 ['ydiff: skipped b.lock\n'])
+
     def test_parse_invalid_hunk_meta(self):
         patch = b"""\
 spam
@@ -683,7 +1293,7 @@ Added: svn:keywords
 
         hunk = out[0]._hunks[1]
         self.assertEqual(hunk._hunk_headers, ['Added: svn:keywords\n'])
-        self.assertEqual(hunk._hunk_list, [('+', 'Id\n')])
+        self.assertEqual(hunk._hunk_list, ['+Id\n'])
 
     def test_parse_hunk_with_path_like_lines(self):
         patch = b"""\
@@ -703,8 +1313,8 @@ Added: svn:keywords
         self.assertEqual(len(out), 1)
         self.assertEqual(len(out[0]._hunks), 1)
         self.assertEqual(len(out[0]._hunks[0]._hunk_list), 4)
-        self.assertEqual(out[0]._hunks[0]._hunk_list[2], ('-', '-- a\n'))
-        self.assertEqual(out[0]._hunks[0]._hunk_list[3], ('+', '++ b\n'))
+        self.assertEqual(out[0]._hunks[0]._hunk_list[2], '--- a\n')
+        self.assertEqual(out[0]._hunks[0]._hunk_list[3], '+++ b\n')
 
 
 class UtilsTest(unittest.TestCase):
@@ -718,16 +1328,68 @@ class UtilsTest(unittest.TestCase):
         with mock.patch('shutil.get_terminal_size', side_effect=Exception):
             self.assertEqual(ydiff._terminal_width(), 80)
 
+    def test_non_negative_int(self):
+        self.assertEqual(ydiff._non_negative_int('0'), 0)
+        self.assertEqual(ydiff._non_negative_int('3'), 3)
+        for value in ('-1', 'a', ''):
+            self.assertRaises(argparse.ArgumentTypeError,
+                              ydiff._non_negative_int, value)
+
+    @mock.patch('sys.stderr', new_callable=io.StringIO)
+    def test_jobs_negative(self, m_stderr):
+        for option in ('--jobs', '--diff-jobs'):
+            with mock.patch('sys.argv', ['ydiff', option, '-2']):
+                self.assertRaises(SystemExit, ydiff._parse_args)
+            self.assertIn(option + ': invalid non-negative int value: ',
+                          m_stderr.getvalue())
+
 
 class AllThemesTest(unittest.TestCase):
 
     def setUp(self):
         self._orig_cache = ydiff._THEMES_CACHE
         ydiff._THEMES_CACHE = None
+        # Themes compiled with mocks must not be seen by other tests
+        self._home = tempfile.TemporaryDirectory()
+        self._env = mock.patch.dict(os.environ, {
+            'XDG_CACHE_HOME': os.path.join(self._home.name, 'cache'),
+            'XDG_CONFIG_HOME': os.path.join(self._home.name, 'config'),
+        })
+        self._env.start()
 
     def tearDown(self):
+        self._env.stop()
+        self._home.cleanup()
         ydiff._THEMES_CACHE = self._orig_cache
 
+    def _write_config(self, text):
+        cfg = os.path.join(self._home.name, 'config', 'ydiff', 'themes.ini')
+        os.makedirs(os.path.dirname(cfg), exist_ok=True)
+        with open(cfg, 'w') as f:
+            f.write(text)
+        return cfg
+
+    def test_cached(self):
+        themes = ydiff._all_themes()
+        ydiff._THEMES_CACHE = None
+        with mock.patch('ydiff._parse_themes') as m_parse:
+            self.assertEqual(ydiff._all_themes(), themes)
+        self.assertFalse(m_parse.called)
+
+    def test_cache_invalidated_by_config(self):
+        cfg = self._write_config('[default]\nheader = 31\n')
+        self.assertEqual(ydiff._all_themes()['default']['header'], ['31'])
+
+        self._write_config('[default]\nheader = 32\n')
+        st = os.stat(cfg)
+        os.utime(cfg, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+        ydiff._THEMES_CACHE = None
+        self.assertEqual(ydiff._all_themes()['default']['header'], ['32'])
+
+        os.remove(cfg)
+        ydiff._THEMES_CACHE = None
+        self.assertEqual(ydiff._all_themes()['default']['header'], ['36'])
+
     @mock.patch('os.path.exists', return_value=False)
     def test_no_config(self, m_exists):
         themes = ydiff._all_themes()
@@ -767,6 +1429,565 @@ class AllThemesTest(unittest.TestCase):
         self.assertRaises(KeyError, ydiff._all_themes)
 
 
+class ModelCacheTest(unittest.TestCase):
+
+    patch = b"""\
+--- a
++++ b
+@@ -1,2 +1,2 @@
+-foo\tbar
++foo\tbaz
+ common
+"""
+
+    def setUp(self):
+        self._dir = tempfile.TemporaryDirectory()
+        self._cache = ydiff._ModelCache(1024, self._dir.name)
+
+    def tearDown(self):
+        self._dir.cleanup()
+
+    def _markup(self, **kwargs):
+        marker = ydiff.DiffMarker(model_cache=self._cache, **kwargs)
+        diffs = ydiff.DiffParser(self.patch.splitlines(True)).parse()
+        return ''.join(ydiff._markup_diffs(marker, diffs, 'SEP'))
+
+    def test_save_load(self):
+        self.assertIsNone(self._cache.load('foo'))
+        self._cache.save('foo', [[((1, 'a'), (1, 'a'), False, None)]])
+        self.assertEqual(self._cache.load('foo'),
+                         [[((1, 'a'), (1, 'a'), False, None)]])
+
+    def test_prune(self):
+        for i, name in enumerate(['c', 'a', 'b']):
+            self._cache.save(name, 'x' * 400)
+            path = os.path.join(self._dir.name, name)
+            os.utime(path, (i, i))
+        self._cache.prune()
+        self.assertEqual(sorted(os.listdir(self._dir.name)), ['a', 'b'])
+
+    def test_markup_cached(self):
+        for side_by_side in (False, True):
+            want = self._markup(side_by_side=side_by_side, width=20)
+            with mock.patch('ydiff.Hunk.mdiff', side_effect=AssertionError):
+                self.assertEqual(self._markup(side_by_side=side_by_side,
+                                              width=20), want)
+                # Width and theme are not part of the key
+                self._markup(side_by_side=side_by_side, width=30,
+                             theme='dark')
+
+    def test_markup_key_options(self):
+        self._markup(side_by_side=True, tab_width=4)
+        with mock.patch('ydiff.Hunk.mdiff', return_value=[]) as m_mdiff:
+            self._markup(side_by_side=True, tab_width=2)
+            self._markup(side_by_side=True, tab_width=4, word_diff='myers')
+        self.assertEqual(m_mdiff.call_count, 2)
+
+    def test_markup_raw_not_saved(self):
+        with mock.patch('time.monotonic', side_effect=itertools.count()):
+            self._markup(render_budget_ms=1)
+        self.assertEqual(os.listdir(self._dir.name), [])
+
+    def test_worker_marker_reused(self):
+        diff = next(ydiff.DiffParser(self.patch.splitlines(True)).parse())
+        with mock.patch.dict(ydiff._WORKER_MARKERS, clear=True):
+            for _ in range(3):
+                # Options are pickled for each diff sent to a worker
+                opts = pickle.loads(pickle.dumps({'model_cache': self._cache}))
+                ydiff._markup_diff_worker(opts, diff)
+            self.assertEqual(len(ydiff._WORKER_MARKERS), 1)
+
+
+class ImportTest(unittest.TestCase):
+
+    def test_import_is_lazy_and_fast(self):
+        code = ('import sys, time\n'
+                'start = time.perf_counter()\n'
+                'import ydiff\n'
+                'print(time.perf_counter() - start)\n'
+                'print(" ".join(sys.modules))\n')
+        out = subprocess.check_output(
+            [sys.executable, '-c', code],
+            cwd=os.path.dirname(os.path.abspath(ydiff.__file__)))
+        seconds, modules = out.decode('utf-8').splitlines()
+        for name in ('argparse', 'configparser', 'difflib', 'shutil',
+                     'subprocess', 'threading'):
+            self.assertNotIn(name, modules.split(), name)
+        # Generous budget that still catches heavy work at import time
+        self.assertLess(float(seconds), 0.5)
+
+
+class PipelineTest(unittest.TestCase):
+
+    def test_stages_in_order(self):
+        pipeline = ydiff._Pipeline(range(1000), [
+            ('double', lambda xs: (x * 2 for x in xs)),
+            ('str', lambda xs: (str(x) for x in xs)),
+        ], depth=2, batch=7)
+        self.assertEqual(list(pipeline), [str(x * 2) for x in range(1000)])
+        self.assertEqual([x[0] for x in pipeline.blocked], ['double', 'str'])
+
+    def test_error_propagated(self):
+        def fail(xs):
+            for x in xs:
+                if x == 3:
+                    raise ValueError('spam')
+                yield x
+
+        pipeline = ydiff._Pipeline(range(10), [
+            ('fail', fail),
+            ('echo', lambda xs: xs),
+        ])
+        self.assertRaises(ValueError, list, pipeline)
+
+    def test_pipeline_to_pager(self):
+        patch = b"""\
+--- a
++++ b
+@@ -1,2 +1,2 @@
+-foo
++bar
+ common
+"""
+        write = mock.Mock()
+        marker = ydiff.DiffMarker()
+        stats = ydiff._Stats()
+        ydiff._pipeline_to_pager(
+            iter(patch.splitlines(True)),
+            lambda lines: ydiff.DiffParser(lines).events(),
+            lambda events: ydiff._markup_events(marker, events, 'SEP'),
+            ydiff._PagerWriter(write, mock.Mock()), stats)
+        written = b''.join(x[0][0] for x in write.call_args_list)
+        self.assertIn(b'-\x1b[0m\x1b[31m\x1b[7m\x1b[31mfoo', written)
+        self.assertEqual([x[0] for x in stats.blocked],
+                         ['read', 'parse', 'render', 'write'])
+
+
+class NonBlockingIOTest(unittest.TestCase):
+
+    def setUp(self):
+        self.in_r, self.in_w = os.pipe()
+        self.out_r, self.out_w = os.pipe()
+
+    def tearDown(self):
+        for fd in (self.in_r, self.in_w, self.out_r, self.out_w):
+            with contextlib.suppress(OSError):
+                os.close(fd)
+
+    def _drain(self, received):
+        with os.fdopen(self.out_r, 'rb') as f:
+            received.append(f.read())
+
+    def _feed(self, data):
+        with os.fdopen(self.in_w, 'wb') as f:
+            f.write(data)
+
+    def test_lines(self):
+        data = b'foo\n\nbar\r\nx\ry\n' * 5000 + b'no newline'
+        writer = threading.Thread(target=self._feed, args=(data,))
+        writer.start()
+        nbio = ydiff._NonBlockingIO(self.in_r, self.out_w, limit=1024)
+        lines = list(nbio)
+        nbio.close()
+        writer.join()
+        self.assertEqual(lines, io.BytesIO(data).readlines())
+
+    def test_long_line(self):
+        data = b'x' * 300000 + b'\nfoo\n' + b'y' * 200000
+        writer = threading.Thread(target=self._feed, args=(data,))
+        writer.start()
+        nbio = ydiff._NonBlockingIO(self.in_r, self.out_w, limit=1024)
+        lines = list(nbio)
+        nbio.close()
+        writer.join()
+        self.assertEqual(lines, io.BytesIO(data).readlines())
+        self.assertEqual(nbio._ahead, 0)
+
+    def test_write_with_backpressure(self):
+        os.write(self.in_w, b'foo\nbar\n')
+        os.close(self.in_w)
+        received = []
+        reader = threading.Thread(target=self._drain, args=(received,))
+        reader.start()
+        nbio = ydiff._NonBlockingIO(self.in_r, self.out_w, limit=16)
+        for line in nbio:
+            for _ in range(10000):
+                nbio.write(line * 3)
+                self.assertLessEqual(len(nbio._out), 16 + len(line) * 3)
+        nbio.flush()
+        nbio.close()
+        os.close(self.out_w)
+        reader.join()
+        self.assertEqual(received, [b'foo\n' * 30000 + b'bar\n' * 30000])
+
+    def test_blocking_restored(self):
+        nbio = ydiff._NonBlockingIO(self.in_r, self.out_w)
+        self.assertFalse(os.get_blocking(self.in_r))
+        nbio.close()
+        self.assertTrue(os.get_blocking(self.in_r))
+        self.assertTrue(os.get_blocking(self.out_w))
+
+    def test_not_a_pipe(self):
+        with tempfile.TemporaryFile() as f:
+            self.assertIsNone(ydiff._nonblocking_io(f, f))
+        self.assertIsNone(ydiff._nonblocking_io(io.BytesIO(), None))
+
+
+class MarkupDiffsTest(unittest.TestCase):
+
+    def test_separator_between_paths(self):
+        patch = b"""\
+--- a
++++ b
+@@ -1 +1 @@
+-foo
++bar
+@@ -10 +10 @@
+-spam
++eggs
+--- c
++++ c
+@@ -1 +1 @@
+-c
++d
+"""
+        marker = ydiff.DiffMarker()
+        for eager in (False, True):
+            diffs = ydiff.DiffParser(patch.splitlines(True)).parse(eager)
+            out = list(ydiff._markup_diffs(marker, diffs, 'SEP'))
+            self.assertEqual(out.count('SEP'), 1)
+            self.assertEqual(len(out), 14)
+
+        events = ydiff.DiffParser(patch.splitlines(True)).events()
+        self.assertEqual(list(ydiff._markup_events(marker, events, 'SEP')),
+                         out)
+
+    def test_events_width_grows(self):
+        patch = b"""\
+--- a
++++ b
+@@ -1 +1 @@
+-foo
++bar
+@@ -100 +100 @@
+-spam
++eggs
+"""
+        marker = ydiff.DiffMarker(side_by_side=True, width=10)
+        events = ydiff.DiffParser(patch.splitlines(True)).events()
+        out = [ydiff._ANSI_RE.sub('', x)
+               for x in ydiff._markup_events(marker, events, 'SEP')]
+        self.assertEqual(out[3], '1 foo        1 bar\n')
+        self.assertEqual(out[5], '100 spam       100 eggs\n')
+
+        # Whole diff is rendered with width of last hunk
+        diffs = ydiff.DiffParser(patch.splitlines(True)).parse()
+        out = [ydiff._ANSI_RE.sub('', x)
+               for x in ydiff._markup_diffs(marker, diffs, 'SEP')]
+        self.assertEqual(out[3], '  1 foo          1 bar\n')
+
+
+class MarkupDiffsParallelTest(unittest.TestCase):
+
+    def test_same_as_serial(self):
+        patch = b"""\
+--- a
++++ b
+@@ -1,2 +1,2 @@
+-foo
++bar
+ common
+"""
+
+        def diffs():
+            return ydiff.DiffParser(iter(patch.splitlines(True) * 5)).parse()
+
+        marker_opts = dict(side_by_side=True, width=20)
+        want = ''.join(ydiff._markup_diffs(
+            ydiff.DiffMarker(**marker_opts), diffs(), 'SEP\n'))
+        got = ''.join(ydiff._markup_diffs_parallel(
+            marker_opts, diffs(), 'SEP\n', 2))
+        self.assertEqual(want, got)
+        self.assertEqual(got.count('SEP\n'), 4)
+
+
+class PagerWriterTest(unittest.TestCase):
+
+    def test_first_screen_then_chunks(self):
+        write, flush = mock.Mock(), mock.Mock()
+        out = ydiff._PagerWriter(write, flush, buffer_size=13, first_screen=2)
+        out.write('a\n')
+        self.assertFalse(write.called)
+        out.write('你\n')
+        write.assert_called_once_with('a\n你\n'.encode('utf-8'))
+        flush.assert_called_once_with()
+
+        write.reset_mock()
+        for _ in range(4):
+            out.write('xy\n')
+        self.assertFalse(write.called)
+        out.write('z\n')
+        write.assert_called_once_with(b'xy\nxy\nxy\nxy\nz\n')
+        self.assertEqual(flush.call_count, 1)
+
+        write.reset_mock()
+        out.write('end\n')
+        out.flush()
+        write.assert_called_once_with(b'end\n')
+        self.assertEqual(flush.call_count, 2)
+
+    def test_flush_early(self):
+        write, flush = mock.Mock(), mock.Mock()
+        out = ydiff._PagerWriter(write, flush, first_screen=3)
+        out.write('a\n')
+        out.flush_early()
+        write.assert_called_once_with(b'a\n')
+        out.write('b\n')
+        out.write('c\n')
+        self.assertEqual(write.call_count, 2)
+
+        # First screen is complete
+        out.write('d\n')
+        out.flush_early()
+        self.assertEqual(write.call_count, 2)
+
+    def test_flush_empty(self):
+        write, flush = mock.Mock(), mock.Mock()
+        out = ydiff._PagerWriter(write, flush)
+        out.flush()
+        self.assertFalse(write.called)
+        self.assertTrue(flush.called)
+
+
+class BuiltinPagerTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        # Like ydiff.py, terminal modules are only imported where needed
+        try:
+            import pty
+            import termios
+        except ImportError:
+            raise unittest.SkipTest('needs pty and termios')
+        cls.pty, cls.termios = pty, termios
+
+    def _patch(self, files):
+        for i in range(files):
+            yield b'--- a/f%d\n' % i
+            yield b'+++ b/f%d\n' % i
+            for j in range(3):
+                yield b'@@ -%d,2 +%d,2 @@\n' % (j * 10 + 1, j * 10 + 1)
+                yield b'-foo %d\n' % j
+                yield b'+bar %d\n' % j
+                yield b' common\n'
+
+    def _pager(self, files=10, side_by_side=False):
+        self.read = 0
+
+        def reading():
+            for line in self._patch(files):
+                self.read += 1
+                yield line
+
+        pager = ydiff._BuiltinPager(
+            ydiff.DiffParser(reading()).events(),
+            dict(side_by_side=side_by_side, width=20))
+        pager.resize(80, 9)
+        return pager
+
+    def _rows(self, pager):
+        return [re.sub(r'\x1b\[[0-9;]*m', '', x).rstrip('\n')
+                for x in pager._screen()[0]]
+
+    def test_renders_on_demand(self):
+        pager = self._pager()
+        self.assertEqual(self._rows(pager), [
+            '--- a/f0', '+++ b/f0', '@@ -1,2 +1,2 @@', '-foo 0', '+bar 0',
+            ' common', '@@ -11,2 +11,2 @@', '-foo 1'])
+        self.assertLess(self.read, 15)
+        self.assertEqual(len(pager._rendered), 3)
+        self.assertEqual(len(pager._units), 3)
+
+    def test_scroll(self):
+        pager = self._pager()
+        pager.command(b'jj')
+        self.assertEqual(self._rows(pager)[0], '@@ -1,2 +1,2 @@')
+        pager.command(b' ')
+        self.assertEqual(self._rows(pager)[0], '@@ -21,2 +21,2 @@')
+        pager.command(b'\x1b[A')
+        self.assertEqual(self._rows(pager)[0], ' common')
+        pager.command(b'b')
+        pager.command(b'b')
+        self.assertEqual(pager._top, (0, 0))
+
+    def test_files(self):
+        pager = self._pager()
+        pager.command(b'n')
+        pager.command(b'n')
+        self.assertEqual(self._rows(pager)[:2], ['─' * 79, '--- a/f2'])
+        pager.command(b'j')
+        pager.command(b'N')
+        self.assertEqual(self._rows(pager)[1], '--- a/f2')
+        pager.command(b'p')
+        self.assertEqual(self._rows(pager)[1], '--- a/f1')
+        self.assertIn('file 2/3+: +++ b/f1', pager.draw())
+
+    def test_bottom(self):
+        pager = self._pager()
+        pager.command(b'G')
+        rows = self._rows(pager)
+        self.assertEqual(len(rows), 8)
+        self.assertEqual(rows[-1], ' common')
+        self.assertIn('file 10/10: +++ b/f9 (END)', pager.draw())
+        pager.command(b'j')
+        self.assertEqual(self._rows(pager), rows)
+        pager.command(b'g')
+        self.assertEqual(pager._top, (0, 0))
+
+    def test_short_input(self):
+        pager = self._pager(files=0)
+        pager.command(b'G')
+        self.assertEqual(pager._screen(), ([], False))
+        self.assertIn('(END)', pager.draw())
+        pager = self._pager(files=1)
+        pager.resize(80, 50)
+        pager.command(b'd')
+        self.assertEqual(pager._top, (0, 0))
+
+    def test_resize_renders_again(self):
+        pager = self._pager(side_by_side=True)
+        pager._marker._width = 0
+        with mock.patch('ydiff._terminal_width', return_value=80):
+            pager.resize(80, 9)
+            wide = pager._screen()[0]
+        units = len(pager._units)
+        with mock.patch('ydiff._terminal_width', return_value=40):
+            pager.resize(40, 9)
+            narrow = pager._screen()[0]
+        self.assertEqual(len(pager._units), units)
+        self.assertNotEqual(narrow[3], wide[3])
+
+    def test_cache_evicted(self):
+        pager = self._pager(files=100)
+        with mock.patch('ydiff._PAGER_CACHE', 5):
+            for _ in range(20):
+                pager.command(b' ')
+        self.assertEqual(len(pager._rendered), 5)
+
+    def test_run(self):
+        master, slave = self.pty.openpty()
+        os.write(master, b'nq')
+        pager = self._pager()
+        with os.fdopen(slave, 'rb', buffering=0) as tty:
+            with os.fdopen(os.dup(slave), 'wb') as out:
+                saved = self.termios.tcgetattr(slave)
+                pager.run(tty, out)
+                self.assertEqual(self.termios.tcgetattr(slave), saved)
+        output = os.read(master, 65536)
+        os.close(master)
+        self.assertIn(b'\x1b[?1049h', output)
+        self.assertTrue(output.endswith(b'\x1b[?1049l'))
+        self.assertIn(b'file 1/2+: +++ b/f0', output)
+
+
+class StatsTest(unittest.TestCase):
+
+    def _run(self, stats, side_by_side):
+        patch = b"""\
+--- a
++++ b
+@@ -1,3 +1,3 @@
+-foo
++bar
+ common
+-spam
++eggs
+"""
+        stats.install()
+        try:
+            marker = ydiff.DiffMarker(side_by_side=side_by_side, width=20)
+            write = stats.write(mock.Mock())
+            stream = stats.read(iter(patch.splitlines(True)))
+            for diff in ydiff.DiffParser(stream).parse():
+                for line in marker.markup(diff):
+                    write(line.encode('utf-8'))
+        finally:
+            stats.uninstall()
+
+    def test_counters(self):
+        # Every clock reading is one second later
+        with mock.patch('time.monotonic', side_effect=itertools.count()):
+            stats = ydiff._Stats()
+            self._run(stats, True)
+        self.assertEqual(stats.counters, {
+            'bytes_read': 58,
+            'lines_read': 8,
+            'diffs': 1,
+            'hunks': 1,
+            'changed_pairs': 2,
+            'word_diff_hits': 0,
+            'word_diff_misses': 2,
+        })
+        self.assertIsNotNone(stats.first_byte)
+        for key in ('read', 'parse', 'mdiff', 'word_diff', 'colorize',
+                    'split', 'write'):
+            self.assertGreater(stats.timers[key], 0, key)
+
+    def test_uninstall(self):
+        orig = (ydiff._word_diff, ydiff._strwrap, ydiff.Hunk.mdiff,
+                ydiff._Palette.colorize, ydiff.DiffParser.parse,
+                ydiff.DiffMarker._diff_words)
+        self._run(ydiff._Stats(), False)
+        self.assertEqual(orig, (ydiff._word_diff, ydiff._strwrap,
+                                ydiff.Hunk.mdiff, ydiff._Palette.colorize,
+                                ydiff.DiffParser.parse,
+                                ydiff.DiffMarker._diff_words))
+
+    def test_report(self):
+        stats = ydiff._Stats()
+        self._run(stats, False)
+        stats.blocked = [['read', 0.5, 0.25]]
+        text = stats.report()
+        self.assertIn('ydiff: bytes_read 58, lines_read 8, diffs 1, hunks 1, '
+                      'changed_pairs 2, word_diff_hits 0, '
+                      'word_diff_misses 2\n', text)
+        self.assertIn('ydiff: time read ', text)
+        self.assertIn(' first_byte ', text)
+        self.assertIn('ydiff: blocked on input/output: read 0.50s/0.25s\n',
+                      text)
+
+        report = json.loads(stats.report('json'))
+        self.assertEqual(report['counters']['changed_pairs'], 2)
+        self.assertEqual(report['blocked'],
+                         {'read': {'input': 0.5, 'output': 0.25}})
+        self.assertEqual(set(report['timers']), set(ydiff._Stats.TIMERS) |
+                         {'first_byte', 'total'})
+
+    def test_word_diff_memo(self):
+        stats = ydiff._Stats()
+        stats.install()
+        try:
+            marker = ydiff.DiffMarker()
+            for a, b in [('foo', 'bar'), ('spam', 'eggs'), ('foo', 'bar')]:
+                marker._diff_words(a, b)
+        finally:
+            stats.uninstall()
+        self.assertEqual(stats.counters['changed_pairs'], 3)
+        self.assertEqual(stats.counters['word_diff_hits'], 1)
+        self.assertEqual(stats.counters['word_diff_misses'], 2)
+
+    def test_stats_from_env(self):
+        for value, want in (('', None), ('0', None), ('no', None),
+                            ('1', 'text'), ('True', 'text'),
+                            ('json', 'json')):
+            self.assertEqual(ydiff._stats_from_env(value), want, value)
+
+    def test_parse_args(self):
+        with mock.patch('sys.argv', ['ydiff']), \
+                mock.patch.dict(os.environ, {'YDIFF_STATS': '0'}):
+            self.assertIsNone(ydiff._parse_args()[0].stats)
+
+
 class MainUnitTests(unittest.TestCase):
 
     @mock.patch('ydiff.DiffMarker.markup',
@@ -786,6 +2007,17 @@ class MainUnitTests(unittest.TestCase):
             opts.tab_width = 8
             opts.wrap = False
             opts.theme = 'default'
+            opts.pipeline = False
+            opts.jobs = 1
+            opts.max_intraline_lines = 0
+            opts.render_budget_ms = 0
+            opts.stats = None
+            opts.buffer_size = 65536
+            opts.low_latency = False
+            opts.cache = False
+            opts.nonblocking = False
+            opts.include = None
+            opts.exclude = None
 
             ydiff.markup_to_pager(b'', opts)
             self.assertTrue(m_popen.called)
@@ -794,6 +2026,16 @@ class MainUnitTests(unittest.TestCase):
             self.assertEqual(ydiff.DiffMarker.markup.call_count, 2)
 
     def test_get_patch_stream_stdin_file(self):
+        with tempfile.TemporaryFile() as f:
+            f.write(b'foo\n')
+            f.seek(0)
+            with mock.patch('sys.stdin', f):
+                stream = ydiff._get_patch_stream([], False)
+                self.assertIsInstance(stream, ydiff._MappedFile)
+                self.assertEqual(list(stream), [b'foo\n'])
+                stream.close()
+
+    def test_get_patch_stream_stdin_empty_file(self):
         with mock.patch('os.fstat') as m_fstat:
             m_fstat.return_value.st_mode = 33188  # S_IFREG
             self.assertEqual(ydiff._get_patch_stream(
@@ -806,10 +2048,22 @@ class MainUnitTests(unittest.TestCase):
             self.assertIsNone(ydiff._get_patch_stream([], True))
             self.assertIn('no log support', m_stderr.getvalue())
 
+    @mock.patch('sys.stderr', new_callable=io.StringIO)
+    def test_get_patch_stream_tool_missing(self, m_stderr):
+        with mock.patch('ydiff._revision_control_probe',
+                        return_value='Mercurial'), \
+                mock.patch.dict(ydiff._VCS_INFO, {'Mercurial': dict(
+                    ydiff._VCS_INFO['Mercurial'], diff=['no-such-cmd'])}):
+            self.assertIsNone(ydiff._get_patch_stream([], False, 3))
+            self.assertIsNone(ydiff._get_patch_stream([], False))
+            self.assertIn('Not in a supported workspace',
+                          m_stderr.getvalue())
+
     @mock.patch('sys.stdout', new_callable=mock.Mock)
     @mock.patch('ydiff._parse_args',
                 return_value=(mock.Mock(
-                    theme='default', color='auto', log=False), []))
+                    theme='default', color='auto', log=False, files=None,
+                    list_files=False), []))
     @mock.patch('ydiff._get_patch_stream', return_value=io.BytesIO(b'foo'))
     def test_main_pipe_output(self, m_stream, m_args, m_stdout):
         # mock buffer for python 3
@@ -819,6 +2073,35 @@ class MainUnitTests(unittest.TestCase):
         ydiff._main()
         m_stdout.buffer.write.assert_called_with(b'foo')
 
+    @mock.patch('sys.stdout', new_callable=mock.Mock)
+    def test_main_files(self, m_stdout):
+        m_stdout.buffer = io.BytesIO()
+        m_stdout.isatty.return_value = False
+        patch = (b'--- a\n+++ a\n@@ -1 +1 @@\n-a\n+b\n'
+                 b'--- c\n+++ c\n@@ -1 +1 @@\n-c\n+d\n')
+        with tempfile.TemporaryFile() as f:
+            f.write(patch)
+            f.seek(0)
+            with mock.patch('sys.stdin', f), \
+                    mock.patch('sys.argv', ['ydiff', '--files', '2']):
+                self.assertEqual(ydiff._main(), 0)
+            self.assertEqual(m_stdout.buffer.getvalue(),
+                             patch[patch.index(b'--- c'):])
+
+            f.seek(0)
+            with mock.patch('sys.stdin', f), \
+                    mock.patch('sys.argv', ['ydiff', '--list-files']):
+                self.assertEqual(ydiff._main(), 0)
+            m_stdout.write.assert_called_with('2\tc\n')
+
+    @mock.patch('sys.stderr', new_callable=io.StringIO)
+    def test_main_files_not_a_file(self, m_stderr):
+        with mock.patch('ydiff._get_patch_stream',
+                        return_value=io.BytesIO(b'foo')), \
+                mock.patch('sys.argv', ['ydiff', '--files', '2']):
+            self.assertEqual(ydiff._main(), 1)
+        self.assertIn('need a patch file', m_stderr.getvalue())
+
     def test_main_unknown_theme(self):
         with mock.patch('sys.stderr', new_callable=io.StringIO) as m_stderr:
             with mock.patch('ydiff._parse_args',
@@ -827,6 +2110,137 @@ class MainUnitTests(unittest.TestCase):
                 self.assertIn('Unknown theme', m_stderr.getvalue())
 
 
+class RevisionControlProbeTest(unittest.TestCase):
+
+    def setUp(self):
+        self._ws = tempfile.TemporaryDirectory()
+        self._top = os.path.realpath(self._ws.name)
+        self._sub = os.path.join(self._top, 'a', 'b')
+        os.makedirs(self._sub)
+        self._env = mock.patch.dict(os.environ)
+        self._env.start()
+        for name in ('GIT_DIR', 'P4CONFIG', 'P4CLIENT'):
+            os.environ.pop(name, None)
+
+    def tearDown(self):
+        self._env.stop()
+        self._ws.cleanup()
+
+    def _probe(self, probes=None):
+        info = {name: dict(ops, probe=probes.get(name, ['false']))
+                for name, ops in ydiff._VCS_INFO.items()} if probes else {}
+        with mock.patch.dict(ydiff._VCS_INFO, info):
+            with mock.patch('os.getcwd', return_value=self._sub):
+                return ydiff._revision_control_probe()
+
+    def test_marker_in_parent(self):
+        os.mkdir(os.path.join(self._top, 'a', '.hg'))
+        with mock.patch('subprocess.Popen') as m_popen:
+            self.assertEqual(self._probe(), 'Mercurial')
+        self.assertFalse(m_popen.called)
+
+    def test_p4config(self):
+        os.environ['P4CONFIG'] = '.p4config'
+        open(os.path.join(self._top, '.p4config'), 'w').close()
+        with mock.patch('subprocess.Popen') as m_popen:
+            self.assertEqual(self._probe(), 'Perforce')
+        self.assertFalse(m_popen.called)
+
+    def test_no_marker(self):
+        self.assertIsNone(self._probe({'Git': ['true']}))
+        self.assertEqual(self._probe({'Perforce': ['true']}), 'Perforce')
+        with mock.patch('ydiff._probe_commands',
+                        return_value=None) as m_probe:
+            self.assertIsNone(self._probe())
+        m_probe.assert_called_once_with(['Perforce'])
+
+    def test_p4client(self):
+        os.environ['P4CLIENT'] = 'ws'
+        with mock.patch('subprocess.Popen') as m_popen:
+            self.assertEqual(self._probe(), 'Perforce')
+        self.assertFalse(m_popen.called)
+
+        # Set globally, it does not win over another marker
+        os.mkdir(os.path.join(self._top, '.git'))
+        self.assertEqual(self._probe({'Git': ['true']}), 'Git')
+
+    def test_ambiguous_markers_probed(self):
+        os.mkdir(os.path.join(self._top, '.svn'))
+        os.mkdir(os.path.join(self._top, 'a', '.git'))
+        self.assertEqual(self._probe({'Svn': ['true']}), 'Svn')
+        self.assertEqual(self._probe({'Git': ['true'], 'Svn': ['true']}),
+                         'Git')
+        self.assertIsNone(self._probe({'Mercurial': ['true']}))
+
+    def test_probe_timeout(self):
+        start = time.monotonic()
+        with mock.patch.dict(ydiff._VCS_INFO, {
+                'Git': dict(ydiff._VCS_INFO['Git'], probe=['sleep', '5'])}):
+            self.assertIsNone(ydiff._probe_commands(['Git'], timeout=0.1))
+        self.assertLess(time.monotonic() - start, 3)
+
+    def test_probe_missing_command(self):
+        with mock.patch.dict(ydiff._VCS_INFO, {
+                'Git': dict(ydiff._VCS_INFO['Git'], probe=['no-such-cmd']),
+                'Svn': dict(ydiff._VCS_INFO['Svn'], probe=['true'])}):
+            self.assertEqual(ydiff._probe_commands(['Git', 'Svn']), 'Svn')
+
+
+class DiffJobsTest(unittest.TestCase):
+
+    def test_git_changed_paths(self):
+        self.assertEqual(
+            ydiff._git_changed_paths(b'M\0a b\0R087\0old\0new\0D\0-x\0'),
+            [[':(top)a b'], [':(top)old', ':(top)new'], [':(top)-x']])
+        self.assertEqual(ydiff._git_changed_paths(b''), [])
+
+    def test_hg_changed_paths(self):
+        self.assertEqual(ydiff._hg_changed_paths(b'b\0a\0'),
+                         [['relpath:a'], ['relpath:b']])
+
+    def test_svn_changed_paths(self):
+        self.assertEqual(
+            ydiff._svn_changed_paths(b'M       foo\nA       -x\n'
+                                     b' M      a@b\n'),
+            [['./-x'], ['a@b@'], ['foo']])
+
+    def test_p4_changed_paths(self):
+        self.assertEqual(ydiff._p4_changed_paths(b'/ws/a@b#1\n/ws/c\n'),
+                         [['/ws/a%40b%231'], ['/ws/c']])
+
+    def test_parallel_output_in_order(self):
+        cmds = [[sys.executable, '-c',
+                 'import time; time.sleep(%r); print(%d); print(%d)' % (
+                     0.01 * (i % 3), i, -i)]
+                for i in range(20)]
+        self.assertEqual(
+            list(ydiff._parallel_output(cmds, 4)),
+            [b'%d\n' % x for i in range(20) for x in (i, -i)])
+
+    def _commands(self, groups):
+        info = dict(ydiff._VCS_INFO['Git'], changed=['true'],
+                    paths=lambda _: groups)
+        with mock.patch.dict(ydiff._VCS_INFO, {'Git': info}):
+            return ydiff._diff_commands('Git', ['--cached'], 2)
+
+    def test_diff_commands_batches(self):
+        diff = ydiff._VCS_INFO['Git']['diff'] + ['--cached']
+        self.assertEqual(self._commands([['a'], ['b', 'c'], ['d']]),
+                         [diff + ['a', 'b', 'c'], diff + ['d']])
+        self.assertEqual(self._commands([]), [])
+        with mock.patch('ydiff._DIFF_BATCH', 1):
+            self.assertEqual(self._commands([['a'], ['b'], ['c']]),
+                             [diff + ['a'], diff + ['b'], diff + ['c']])
+
+    def test_diff_commands_fallback(self):
+        self.assertIsNone(ydiff._diff_commands('Git', ['HEAD~1'], 2))
+        self.assertIsNone(ydiff._diff_commands('Git', ['--', 'foo'], 2))
+        for cmd in (['false'], ['no-such-cmd']):
+            info = dict(ydiff._VCS_INFO['Git'], changed=cmd)
+            with mock.patch.dict(ydiff._VCS_INFO, {'Git': info}):
+                self.assertIsNone(ydiff._diff_commands('Git', [], 2))
+
+
 class MainTest(unittest.TestCase):
 
     def setUp(self):
@@ -867,6 +2281,29 @@ class MainTest(unittest.TestCase):
         os.chdir(self._cwd)
         self.assertEqual(ret, 0)
 
+    def test_read_diff_jobs(self):
+        for i in range(30):
+            path = os.path.join(self._ws, 'd%d' % (i % 4), 'f %d' % i)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'w') as f:
+                f.write('line\n' * 20 + '%d\n' % i)
+        cmd = ('set -o errexit; cd %s; git add .; git commit -m files; '
+               'for i in 0 2 4 6 8 10 12; do echo $i > d$((i %% 4))/f\\ $i; '
+               'done; git mv "d1/f 1" d2/renamed; git rm -q "d3/f 3"; '
+               'git add .') % self._ws
+        subprocess.call(cmd, shell=True, stdout=subprocess.PIPE)
+
+        os.chdir(os.path.join(self._ws, 'd1'))
+        streams = [ydiff._get_patch_stream(['--cached'], False, jobs)
+                   for jobs in (1, 3)]
+        single, parallel = [list(x) for x in streams]
+        for stream in streams:
+            stream.close()
+        os.chdir(self._cwd)
+        self.assertIn(b'rename to d2/renamed\n', parallel)
+        self.assertIn(b'deleted file mode 100644\n', parallel)
+        self.assertEqual(parallel, single)
+
     def test_read_log(self):
         sys.argv = [sys.argv[0], '--log', '--pager=cat']
         self._change_file('read_log')
@@ -1,16 +1,17 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
-import configparser
+import bisect
+import collections
 import contextlib
-import difflib
+import itertools
+import marshal
 import os
 import re
-import shutil
 import signal
 import stat
-import subprocess
 import sys
+import time
 import unicodedata
 
 __version__ = '1.5'
@@ -82,8 +83,31 @@ wrap_marker = 95                        # Bright magenta fg
 
 _THEMES_CACHE = {}  # type: dict[str, dict[str, list[str]]]
 _RESET = '\x1b[0m'
+_PIPELINE_DEPTH = 16    # max batches queued between two pipeline stages
+_PIPELINE_BATCH = 256   # max items in a batch passed between pipeline stages
+_PAIRING_BUDGET = 20000  # max line pairs compared in a replace block of a hunk
+_MYERS_MAX_EDITS = 1000  # max tokens inserted/deleted in a word diff by myers
+_JOBS_WINDOW = 4        # max diffs in flight per worker process with --jobs
+_DIFF_BATCH = 16        # max changed paths per diff command with --diff-jobs
+_WRITE_BUFFER = 65536   # default size of chunks written to pager
+_MMAP_CHUNK = 1 << 20   # bytes of mapped input split into lines at a time
+_MODEL_CACHE_SIZE = 100  # default MiB of on-disk cache with --cache
+_INDEX_CACHE_SIZE = 10 << 20    # max bytes of cached indexes of patch files
+_WORD_MEMO_SIZE = 4096  # max line pairs remembered with their word diff
+_NONBLOCKING_LIMIT = 1 << 20    # max bytes read ahead or pending output
+_PAGER_CACHE = 256      # max rendered units kept by --builtin-pager
+_BLANK = ('', '\n')     # filler line in Hunk.mdiff() output
+_DEGRADE_PLAIN = 1      # hunk over budget: no intraline diff, in order pairing
+_DEGRADE_RAW = 2        # render budget spent: raw unified text
+# Kinds of events from DiffParser.events(), each event is a tuple (kind, item)
+EVENT_FILE = 'file'     # item is UnifiedDiff with headers and paths of a file
+EVENT_HUNK = 'hunk'     # item is a complete Hunk of current file
+EVENT_END = 'end'       # item is the same UnifiedDiff as of EVENT_FILE
+
 _ANSI_RE = re.compile(r'\x1b\[[0-9;]*m')
 _WORDS_RE = re.compile(r'[A-Z]{2,}|[A-Z][a-z]+|[a-z]{2,}|[A-Za-z0-9]+|\s|.')
+# Numbers of old and new lines in hunk meta, in bytes
+_HUNK_META_RE = re.compile(rb'^(?:@@|##) -\d+(?:,(\d+))? \+\d+(?:,(\d+))? ')
 
 
 def _all_themes():
@@ -91,55 +115,234 @@ def _all_themes():
     if _THEMES_CACHE:
         return _THEMES_CACHE
 
+    xdg = os.getenv('XDG_CONFIG_HOME', os.path.expanduser('~/.config'))
+    cfg = os.path.join(xdg, 'ydiff', 'themes.ini')
+    try:
+        st = os.stat(cfg)
+        cfg_version = (st.st_mtime_ns, st.st_size)
+    except OSError:
+        cfg_version = None
+    key = (__version__, _BUILTIN_THEMES, cfg, cfg_version)
+
+    _THEMES_CACHE = _load_themes_cache(key)
+    if not _THEMES_CACHE:
+        _THEMES_CACHE = _parse_themes(cfg)
+        _save_themes_cache(key, _THEMES_CACHE)
+    return _THEMES_CACHE
+
+
+def _parse_themes(cfg):
+    import configparser
+
     builtin = configparser.ConfigParser(
         comment_prefixes='#', inline_comment_prefixes='#')
     builtin.read_string(_BUILTIN_THEMES)
-    _THEMES_CACHE = {
+    themes = {
         name: {key: value.split() for key, value in builtin.items(name)}
         for name in builtin.sections()
     }
 
-    xdg = os.getenv('XDG_CONFIG_HOME', os.path.expanduser('~/.config'))
-    cfg = os.path.join(xdg, 'ydiff', 'themes.ini')
     if not os.path.exists(cfg):
-        return _THEMES_CACHE
+        return themes
 
     customized = configparser.ConfigParser(
         comment_prefixes='#', inline_comment_prefixes='#')
     customized.read(cfg)
     for name in customized.sections():
-        if name not in _THEMES_CACHE:
-            _THEMES_CACHE[name] = _THEMES_CACHE['default'].copy()
+        if name not in themes:
+            themes[name] = themes['default'].copy()
         for key, value in customized.items(name):
-            if key not in _THEMES_CACHE[name]:
+            if key not in themes[name]:
                 raise KeyError('Invalid key %r in theme %r' % (key, name))
-            _THEMES_CACHE[name][key] = value.split()
-    return _THEMES_CACHE
+            themes[name][key] = value.split()
+    return themes
+
+
+def _cache_dir():
+    xdg = os.getenv('XDG_CACHE_HOME', os.path.expanduser('~/.cache'))
+    return os.path.join(xdg, 'ydiff')
+
+
+def _load_themes_cache(key):
+    """Returns themes compiled by an earlier run if key still matches, so
+    that parsing themes (and importing configparser) can be skipped."""
+    try:
+        with open(os.path.join(_cache_dir(), 'themes.marshal'), 'rb') as f:
+            cached_key, themes = marshal.load(f)
+    except (OSError, EOFError, ValueError, TypeError):
+        return None
+    return themes if cached_key == key else None
+
+
+def _save_themes_cache(key, themes):
+    path = os.path.join(_cache_dir(), 'themes.marshal')
+    tmp = '%s.%d' % (path, os.getpid())
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(tmp, 'wb') as f:
+            marshal.dump((key, themes), f)
+        os.replace(tmp, path)
+    except OSError:
+        with contextlib.suppress(OSError):
+            os.remove(tmp)
+
+
+class _ModelCache:
+    """On-disk cache of rows of hunks of diffs (see DiffMarker._rows()), which
+    do not depend on width or theme.  An entry is a file named by hash of
+    hunks of a diff and rendering options, modification time of the file is
+    used as last access time to evict least recently used entries once total
+    size is over max_size bytes."""
+
+    def __init__(self, max_size, path=None):
+        self._max_size = max_size
+        self._path = path or os.path.join(_cache_dir(), 'model')
+
+    # Compared by value, a copy sent to a worker process finds the same
+    # marker in _WORKER_MARKERS
+    def __eq__(self, other):
+        return (isinstance(other, _ModelCache) and
+                (self._max_size, self._path) == (other._max_size, other._path))
+
+    def __hash__(self):
+        return hash((self._max_size, self._path))
+
+    def key(self, diff, opts):
+        import hashlib
+
+        digest = hashlib.sha1(repr((__version__, opts)).encode('utf-8'))
+        for hunk in diff._hunks:
+            digest.update(hunk._hunk_meta.encode('utf-8'))
+            digest.update('\0'.join(hunk._hunk_list).encode('utf-8'))
+            digest.update(b'\1')
+        return digest.hexdigest()
+
+    def load(self, key):
+        path = os.path.join(self._path, key)
+        try:
+            with open(path, 'rb') as f:
+                model = marshal.load(f)
+        except (OSError, EOFError, ValueError, TypeError):
+            return None
+        with contextlib.suppress(OSError):
+            os.utime(path)
+        return model
+
+    def save(self, key, model):
+        path = os.path.join(self._path, key)
+        tmp = '%s.%d' % (path, os.getpid())
+        try:
+            os.makedirs(self._path, exist_ok=True)
+            with open(tmp, 'wb') as f:
+                marshal.dump(model, f)
+            os.replace(tmp, path)
+        except OSError:
+            with contextlib.suppress(OSError):
+                os.remove(tmp)
+
+    def prune(self):
+        """Removes least recently used entries until total size is within
+        max_size"""
+        entries = []
+        with contextlib.suppress(OSError):
+            for name in os.listdir(self._path):
+                path = os.path.join(self._path, name)
+                with contextlib.suppress(OSError):
+                    st = os.stat(path)
+                    entries.append((st.st_mtime, st.st_size, path))
+        total = sum(x[1] for x in entries)
+        for _, size, path in sorted(entries):
+            if total <= self._max_size:
+                break
+            with contextlib.suppress(OSError):
+                os.remove(path)
+            total -= size
+
+
+class _Palette:
+    """Escape sequences of a theme, compiled once so that colorizing a line
+    does not resolve the theme again."""
+
+    __slots__ = ('codes', '_prefixes', '_tables')
+
+    def __init__(self, theme='default'):
+        colors = _all_themes()[theme]
+        prefixes = {kind: ''.join('\x1b[%sm' % c for c in codes)
+                    for kind, codes in colors.items()}
+        self.codes = tuple(set(
+            '\x1b[%sm' % c for c in sum(colors.values(), [])))
+        # Changed text carries markers from _word_diff() to be substituted
+        self._tables = {
+            'replaced_old_text': (prefixes['old_line'], (
+                ('\0-', prefixes['replaced_old_text']),
+                ('\0^', prefixes['deleted_text']),
+                ('\1', _RESET + prefixes['old_line']))),
+            'replaced_new_text': (prefixes['new_line'], (
+                ('\0+', prefixes['replaced_new_text']),
+                ('\0^', prefixes['inserted_text']),
+                ('\1', _RESET + prefixes['new_line']))),
+        }
+        self._prefixes = prefixes
+
+    def colorize(self, text, kind):
+        table = self._tables.get(kind)
+        if table is None:
+            return self._prefixes[kind] + text + _RESET
+        base_color, subs = table
+        for marker, color in subs:
+            text = text.replace(marker, color)
+        return base_color + text + _RESET
 
 
 def _colorize(text, kind, theme='default'):
-    def effect(kind):
-        return ''.join('\x1b[%sm' % c for c in _all_themes()[theme][kind])
-
-    if kind == 'replaced_old_text':
-        base_color = effect('old_line')
-        del_color = effect('replaced_old_text')
-        chg_color = effect('deleted_text')
-        rst_color = _RESET + base_color
-        text = text.replace('\0-', del_color)
-        text = text.replace('\0^', chg_color)
-        text = text.replace('\1', rst_color)
-    elif kind == 'replaced_new_text':
-        base_color = effect('new_line')
-        add_color = effect('replaced_new_text')
-        chg_color = effect('inserted_text')
-        rst_color = _RESET + base_color
-        text = text.replace('\0+', add_color)
-        text = text.replace('\0^', chg_color)
-        text = text.replace('\1', rst_color)
-    else:
-        base_color = effect(kind)
-    return base_color + text + _RESET
+    return _Palette(theme).colorize(text, kind)
+
+
+def _iter_cuts(text, width, color_codes=None):
+    r"""Walks a string once to find where to cut it into pieces of given
+    width of visible chars, respecting involved color codes.
+
+    Yields a 3-tuple for each piece: (offset in text where the piece ends,
+    colors active at that point, width of visible chars in the piece).  The
+    last piece always ends at len(text).  A piece ends right before the first
+    char exceeding the width, so color codes following the last char that
+    fits stay in the piece.
+    """
+    color_codes = color_codes or ()
+    left_width, seen, pos = 0, '', 0
+    for match in itertools.chain(_ANSI_RE.finditer(text), (None,)):
+        end = match.start() if match else len(text)
+        if pos < end:
+            try:
+                text[pos:end].encode('ascii')
+            except UnicodeEncodeError:
+                for ch in text[pos:end]:
+                    if left_width >= width:
+                        yield pos, seen, left_width
+                        left_width = 0
+                    left_width += _char_width(ch)
+                    pos += 1
+            else:
+                # Every char is 1 column, consume as many as fit at once
+                while pos < end:
+                    if left_width >= width:
+                        yield pos, seen, left_width
+                        left_width = 0
+                    n = min(end - pos, max(width - left_width, 1))
+                    pos += n
+                    left_width += n
+        if match:
+            code = match.group()
+            if code in color_codes:
+                seen = '' if code == _RESET else seen + code
+            pos = match.end()
+    yield len(text), seen, left_width
+
+
+def _char_width(ch):
+    if ord(ch) > 127 and unicodedata.east_asian_width(ch) in 'WF':
+        return 2
+    return 1
 
 
 def _strsplit(text, width, color_codes=None):
@@ -152,61 +355,59 @@ def _strsplit(text, width, color_codes=None):
     appended with the resetting sequence, and the second string is prefixed
     with all active colors.
     """
-    color_codes = color_codes or []
-    left_width, seen = 0, ''
-
-    def _iter_segments(text):
-        last = 0
-        for match in _ANSI_RE.finditer(text):
-            start, end = match.span()
-            if start > last:
-                yield text[last:start], None, last, start
-            yield match.group(), match.group(), start, end
-            last = end
-        if last < len(text):
-            yield text[last:], None, last, len(text)
-
-    for chunk, code, start, end in _iter_segments(text):
-        if code:
-            if code in color_codes:
-                seen = '' if code == _RESET else seen + code
-        else:
-            try:
-                chunk.encode('ascii')
-                is_ascii = True
-            except UnicodeEncodeError:
-                is_ascii = False
-            if is_ascii and left_width + len(chunk) <= width:
-                left_width += len(chunk)
-                continue
+    cutoff, seen, left_width = next(_iter_cuts(text, width, color_codes))
+    if cutoff == len(text):
+        return text, '', left_width
+    return (text[:cutoff] + (_RESET if seen else ''),
+            seen + text[cutoff:],
+            left_width)
 
-            for i, ch in enumerate(chunk):
-                if left_width >= width:
-                    cutoff = start + i
-                    return (text[:cutoff] + (_RESET if seen else ''),
-                            seen + text[cutoff:],
-                            left_width)
-                left_width += 1
-                if ord(ch) > 127 and unicodedata.east_asian_width(ch) in 'WF':
-                    left_width += 1
 
-    return text, '', left_width
+def _strwrap(text, width, color_codes=None):
+    r"""Splits a string into pieces of given width in one pass, the same as
+    calling _strsplit() on the right substring over and over again would do.
+
+    Yields 2-tuples: (piece, width of visible chars in the piece).
+    """
+    if not text:
+        return
+    start, active = 0, ''
+    for cutoff, seen, piece_width in _iter_cuts(text, width, color_codes):
+        if cutoff == len(text):
+            yield active + text[start:], piece_width
+        else:
+            piece = text[start:cutoff] + (_RESET if seen else '')
+            yield active + piece, piece_width
+        start, active = cutoff, seen
 
 
 def _strtrim(text, width, wrap_char, pad, color_codes):
-    r"""Trims given string respecting the involved color codes (using
-    strsplit), so that if text is larger than width, it's trimmed to have
-    width-1 chars plus wrap_char. Additionally, if pad is True, short strings
-    are padded with space to have exactly needed width.
+    r"""Trims given string respecting the involved color codes, so that if
+    text is larger than width, it's trimmed to have width-1 chars plus
+    wrap_char. Additionally, if pad is True, short strings are padded with
+    space to have exactly needed width.
 
     Returns resulting string.
     """
-    left, right, left_width = _strsplit(text, width, color_codes)
-    if right or left_width > width:  # asian chars can cause exceeds
-        left = _strsplit(left, width - 1, color_codes)[0] + wrap_char
-    elif pad:
-        left += ' ' * (width - left_width)
-    return left
+    cutoff, seen, left_width = next(_iter_cuts(text, width - 1, color_codes))
+    if cutoff < len(text):
+        # Still fits if the only char left is narrow, look at 2 chars at most
+        pos, rest_width = cutoff, 0
+        while pos < len(text) and rest_width < 2:
+            match = _ANSI_RE.match(text, pos)
+            if match:
+                pos = match.end()
+            else:
+                rest_width += _char_width(text[pos])
+                pos += 1
+        left_width += rest_width
+        if left_width > width:
+            return text[:cutoff] + (_RESET if seen else '') + wrap_char
+    elif left_width > width:  # asian chars can cause exceeds
+        return text + wrap_char
+    if pad:
+        text += ' ' * (width - left_width)
+    return text
 
 
 def _split_to_words(s: str) -> list:
@@ -217,10 +418,11 @@ def _split_to_words(s: str) -> list:
     return _WORDS_RE.findall(s)
 
 
-def _word_diff(a: str, b: str) -> tuple:
+def _word_diff(a: str, b: str, engine: str = 'difflib') -> tuple:
     r"""Takes the from/to texts yield by Hunk.mdiff() which are part of the
     'changed' block, remove the special markers (\0-, \0+, \0^, \1), compare
     word by word and return two new texts with the markers reassemabled.
+    Engine is a key of _WORD_DIFF_ENGINES.
 
     Context: difflib._mdiff() is good for indention detection, but produces
     coarse-grained diffs for the 'changed' block when the similarity is below
@@ -231,7 +433,7 @@ def _word_diff(a: str, b: str) -> tuple:
         a, b = a.replace(t, ''), b.replace(t, '')
     old, new = _split_to_words(a), _split_to_words(b)
     xs, ys = [], []
-    for tag, i, j, m, n in difflib.SequenceMatcher(a=old, b=new).get_opcodes():
+    for tag, i, j, m, n in _WORD_DIFF_ENGINES[engine](old, new):
         x, y = ''.join(old[i:j]), ''.join(new[m:n])
         # print('%s\t%s\n\t%s' % (tag, repr(x), repr(y)), file=sys.stderr)
         if tag == 'equal':
@@ -247,20 +449,292 @@ def _word_diff(a: str, b: str) -> tuple:
     return ''.join(xs), ''.join(ys)
 
 
+def _difflib_opcodes(old: list, new: list) -> list:
+    """Word diff engine 'difflib', plain difflib.SequenceMatcher."""
+    import difflib
+
+    return difflib.SequenceMatcher(a=old, b=new).get_opcodes()
+
+
+def _myers_opcodes(old: list, new: list) -> list:
+    """Word diff engine 'myers', returns opcodes like
+    difflib.SequenceMatcher.get_opcodes() does.
+
+    Common prefix and suffix are trimmed first, identical and whitespace-only
+    changes are then sorted out in linear time, what is left goes through
+    _myers_blocks().  Unlike SequenceMatcher there is no autojunk heuristic,
+    so long lines with many repeated tokens still get a minimal diff.
+    """
+    n, m = len(old), len(new)
+    lo = 0
+    while lo < n and lo < m and old[lo] == new[lo]:
+        lo += 1
+    hi = 0
+    while hi < n - lo and hi < m - lo and old[n - 1 - hi] == new[m - 1 - hi]:
+        hi += 1
+
+    a, b = old[lo:n - hi], new[lo:m - hi]
+    if not a or not b:
+        blocks = []
+    elif ''.join(a).split() == ''.join(b).split():
+        blocks = _whitespace_blocks(a, b) or _myers_blocks(a, b)
+    else:
+        blocks = _myers_blocks(a, b)
+
+    blocks = ([(0, 0, lo)] + [(i + lo, j + lo, k) for i, j, k in blocks] +
+              [(n - hi, m - hi, hi)])
+    opcodes, i, j = [], 0, 0
+    for ai, bj, size in blocks:
+        tag = ('replace' if i < ai and j < bj else 'delete' if i < ai else
+               'insert' if j < bj else None)
+        if tag:
+            opcodes.append((tag, i, ai, j, bj))
+        if size:
+            opcodes.append(('equal', ai, ai + size, bj, bj + size))
+        i, j = ai + size, bj + size
+    return opcodes
+
+
+def _whitespace_blocks(a: list, b: list) -> list:
+    """Returns matching blocks (i, j, size) of two token lists which differ
+    in whitespace only, by pairing up the non-whitespace tokens in order.
+    Returns None if tokens do not pair up."""
+    blocks, i, j = [], 0, 0
+    while i < len(a) or j < len(b):
+        i2, j2 = i, j
+        while i2 < len(a) and a[i2].isspace():
+            i2 += 1
+        while j2 < len(b) and b[j2].isspace():
+            j2 += 1
+        if a[i:i2] == b[j:j2]:
+            i2, j2 = i, j   # same whitespace, match it token by token
+        if i2 < len(a) and j2 < len(b):
+            if a[i2] != b[j2]:
+                return None
+            blocks.append((i2, j2, 1))
+        i, j = i2 + 1, j2 + 1
+    return blocks
+
+
+def _myers_blocks(a: list, b: list) -> list:
+    """Returns matching blocks (i, j, size) of the shortest edit script found
+    by Myers' O(ND) algorithm.  Gives up on matching when the edit distance
+    exceeds _MYERS_MAX_EDITS, the whole thing is then one replacement."""
+    n, m = len(a), len(b)
+    v, trace = {1: 0}, []
+    for d in range(min(n + m, _MYERS_MAX_EDITS) + 1):
+        trace.append(dict(v))
+        for k in range(-d, d + 1, 2):
+            if k == -d or k != d and v[k - 1] < v[k + 1]:
+                x = v[k + 1]
+            else:
+                x = v[k - 1] + 1
+            y = x - k
+            while x < n and y < m and a[x] == b[y]:
+                x, y = x + 1, y + 1
+            v[k] = x
+            if x >= n and y >= m:
+                break
+        else:
+            continue
+        break
+    else:
+        return []
+
+    # Walk back from the end, collecting diagonal moves (matched tokens)
+    blocks, x, y = [], n, m
+    for d in range(len(trace) - 1, -1, -1):
+        v, k = trace[d], x - y
+        if k == -d or k != d and v[k - 1] < v[k + 1]:
+            prev_k = k + 1
+        else:
+            prev_k = k - 1
+        prev_x = v[prev_k]
+        prev_y = prev_x - prev_k
+        size = min(x - max(prev_x, 0), y - max(prev_y, 0))
+        if size > 0:
+            blocks.append((x - size, y - size, size))
+        x, y = prev_x, prev_y
+    blocks.reverse()
+    return blocks
+
+
+_WORD_DIFF_ENGINES = {
+    'difflib': _difflib_opcodes,
+    'myers': _myers_opcodes,
+}
+
+
+def _pair_lines(old, new):
+    r"""Pairs up old and new lines of a hunk, yields the same (from line, to
+    line, changed) tuples as difflib._mdiff() does (see Hunk.mdiff()).
+
+    Lines are matched with difflib.SequenceMatcher, then deleted/inserted lines
+    in between are paired up row by row and padded with blank ('', '\n')
+    lines, just like ndiff output is laid out by difflib._mdiff().  Pure
+    additions and deletions never run a matcher.  In a replace block, lines
+    similar enough are synched up the way ndiff does, but only as long as the
+    number of compared line pairs stays within _PAIRING_BUDGET, the remaining
+    lines are paired up row by row.  This avoids ndiff's quadratic (or worse)
+    _fancy_replace() on large replace blocks.
+
+    Texts of one-sided rows are wrapped with '\0-' or '\0+' and '\1', rows
+    changed on both sides carry no intraline markers since _word_diff() works
+    that out anyway.
+    """
+    if old and new:
+        import difflib
+
+        opcodes = difflib.SequenceMatcher(None, old, new).get_opcodes()
+    else:
+        opcodes = [('replace', 0, len(old), 0, len(new))]
+
+    dels, adds = [], []     # pending run of deleted/inserted line indices
+
+    def flush():
+        for i, j in itertools.zip_longest(dels, adds):
+            yield (_BLANK if i is None else (i + 1, _mark(old[i], '-')),
+                   _BLANK if j is None else (j + 1, _mark(new[j], '+')),
+                   True)
+        del dels[:], adds[:]
+
+    for tag, alo, ahi, blo, bhi in opcodes:
+        if tag == 'equal':
+            yield from flush()
+            for i in range(alo, ahi):
+                yield (i + 1, old[i]), (blo + i - alo + 1, old[i]), False
+            continue
+
+        budget = _PAIRING_BUDGET
+        blocks = [(alo, ahi, blo, bhi)]
+        while blocks:
+            block = blocks.pop()
+            if len(block) == 3:     # synch point
+                yield from flush()
+                i, j, changed = block
+                text = new[j] if changed else old[i]
+                yield (i + 1, old[i]), (j + 1, text), changed
+                continue
+
+            alo, ahi, blo, bhi = block
+            size = (ahi - alo) * (bhi - blo)
+            synch = None
+            if size and size <= budget:
+                budget -= size
+                synch = _synch_point(old, alo, ahi, new, blo, bhi)
+            if synch is None:
+                dels.extend(range(alo, ahi))
+                adds.extend(range(blo, bhi))
+                continue
+            # Lines before the synch point go first, so push them last
+            i, j, _ = synch
+            blocks.append((i + 1, ahi, j + 1, bhi))
+            blocks.append(synch)
+            blocks.append((alo, i, blo, j))
+
+    yield from flush()
+
+
+def _synch_point(old, alo, ahi, new, blo, bhi):
+    """Returns (i, j, changed) for the best matching pair of lines in the
+    replace block old[alo:ahi] -> new[blo:bhi] per ndiff's rules, or None if
+    no pair is similar enough.  Identical lines are only used when there is no
+    similar pair."""
+    import difflib
+
+    best_ratio, cutoff = 0.74, 0.75
+    cruncher = difflib.SequenceMatcher(difflib.IS_CHARACTER_JUNK)
+    eqi = eqj = None
+    for j in range(blo, bhi):
+        bj = new[j]
+        cruncher.set_seq2(bj)
+        for i in range(alo, ahi):
+            ai = old[i]
+            if ai == bj:
+                if eqi is None:
+                    eqi, eqj = i, j
+                continue
+            cruncher.set_seq1(ai)
+            # Cheap upper bounds first, ratio() is only computed when needed
+            if (cruncher.real_quick_ratio() > best_ratio and
+                    cruncher.quick_ratio() > best_ratio and
+                    cruncher.ratio() > best_ratio):
+                best_ratio, best_i, best_j = cruncher.ratio(), i, j
+    if best_ratio >= cutoff:
+        return best_i, best_j, True
+    if eqi is not None:
+        return eqi, eqj, False
+    return None
+
+
+def _pair_in_order(lines):
+    r"""Pairs up old and new lines of a hunk the cheap way, yields the same
+    tuples as _pair_lines() does.  Hunk lines are taken as is (attr char
+    included) and each run of deleted lines is paired up row by row with the
+    run of inserted lines following it, no matcher is run at all.
+    """
+    dels, adds = [], []     # pending run of (line num, text)
+    i = j = 0               # line nums in old and new file
+
+    def flush():
+        for a, b in itertools.zip_longest(dels, adds):
+            yield (_BLANK if a is None else (a[0], _mark(a[1], '-')),
+                   _BLANK if b is None else (b[0], _mark(b[1], '+')),
+                   True)
+        del dels[:], adds[:]
+
+    for line in lines:
+        attr, text = line[0], line[1:]
+        if attr == '+':
+            j += 1
+            adds.append((j, text))
+            continue
+        if attr == '-':
+            if adds:
+                yield from flush()
+            i += 1
+            dels.append((i, text))
+            continue
+        yield from flush()
+        i += 1
+        j += 1
+        yield (i, text), (j, text), False
+
+    yield from flush()
+
+
+def _mark(text, tag):
+    r"""Wraps a whole deleted ('-') or added ('+') line with markers."""
+    return '\0%s%s\1' % (tag, text or ' ')
+
+
 class Hunk:
 
+    __slots__ = ('_hunk_headers', '_hunk_meta', '_old_addr', '_new_addr',
+                 '_hunk_list', '_old_count', '_new_count')
+
     def __init__(self, hunk_headers, hunk_meta, old_addr, new_addr):
         self._hunk_headers = hunk_headers
         self._hunk_meta = hunk_meta
         self._old_addr = old_addr   # tuple (start, offset)
         self._new_addr = new_addr   # tuple (start, offset)
-        self._hunk_list = []        # list of tuple (attr, line)
+        self._hunk_list = []        # list of lines as is, attr char included
+        self._old_count = 0         # number of lines in old view
+        self._new_count = 0         # number of lines in new view
 
     def append(self, hunk_line):
-        """hunk_line is a 2-element tuple: (attr, text), where attr is:
+        """hunk_line is the line as is in the diff, the first char is the attr:
                 '-': old, '+': new, ' ': common
         """
         self._hunk_list.append(hunk_line)
+        attr = hunk_line[0]
+        if attr != '+':
+            self._old_count += 1
+        if attr != '-':
+            self._new_count += 1
+
+    def __len__(self):
+        return len(self._hunk_list)
 
     def mdiff(self):
         r"""The difflib._mdiff() function returns an interator which returns a
@@ -276,28 +750,67 @@ class Hunk:
 
         boolean flag -- None indicates context separation, True indicates
             either "from" or "to" line contains a change, otherwise False.
+
+        The tuples are produced by _pair_lines() which has a bounded cost on
+        large hunks, unlike difflib._mdiff().
         """
-        return difflib._mdiff(self._get_old(), self._get_new())
+        return _pair_lines(self._get_old(), self._get_new())
+
+    def old_lines(self):
+        """Returns a view of lines in old file, attr char stripped."""
+        return _HunkView(self._hunk_list, '+', self._old_count)
+
+    def new_lines(self):
+        """Returns a view of lines in new file, attr char stripped."""
+        return _HunkView(self._hunk_list, '-', self._new_count)
 
     def _get_old(self):
-        return [line for attr, line in self._hunk_list if attr != '+']
+        return list(self.old_lines())
 
     def _get_new(self):
-        return [line for attr, line in self._hunk_list if attr != '-']
+        return list(self.new_lines())
 
     def is_completed(self):
-        return (self._old_addr[1] == len(self._get_old()) and
-                self._new_addr[1] == len(self._get_new()))
+        return (self._old_addr[1] == self._old_count and
+                self._new_addr[1] == self._new_count)
+
+
+class _HunkView:
+    """Read-only view of either side of a hunk without copying its lines."""
+
+    __slots__ = ('_lines', '_skip', '_len')
+
+    def __init__(self, lines, skip, length):
+        self._lines = lines
+        self._skip = skip   # attr char of lines not in this side
+        self._len = length
+
+    def __len__(self):
+        return self._len
+
+    def __iter__(self):
+        skip = self._skip
+        return (x[1:] for x in self._lines if x[0] != skip)
 
 
 class UnifiedDiff:
 
+    __slots__ = ('_headers', '_old_path', '_new_path', '_hunks')
+
     def __init__(self, headers, old_path, new_path, hunks):
         self._headers = headers
         self._old_path = old_path
         self._new_path = new_path
         self._hunks = hunks
 
+    def events(self):
+        """Returns a generator of events of this diff, in the same format as
+        DiffParser.events()"""
+        yield EVENT_FILE, self
+        for hunk in self._hunks:
+            yield EVENT_HUNK, hunk
+        yield EVENT_END, self
+
     def is_old_path(self, line):
         return line.startswith('--- ')
 
@@ -323,9 +836,6 @@ class UnifiedDiff:
         parts = meta.split()
         return addr(parts[1]), addr(parts[2])
 
-    def parse_hunk_line(self, line):
-        return line[0], line[1:]
-
     def is_old(self, line):
         """Exclude old path and header line from svn log --diff output, allow
         '----' likely to see in diff from yaml file
@@ -352,17 +862,132 @@ class UnifiedDiff:
                 line.rstrip().endswith(' differ'))
 
 
+class _PathFilter:
+    """Decides which diffs to skip by their paths, for --include and
+    --exclude.  A glob without '/' matches the last component of a path,
+    otherwise the whole path, where '*' matches '/' too."""
+
+    def __init__(self, include=None, exclude=None, summary=False):
+        import fnmatch
+
+        self._match = fnmatch.fnmatchcase
+        self._include = include or []
+        self._exclude = exclude or []
+        self.summary = summary
+
+    def _matches(self, path, patterns):
+        base = path.rsplit('/', 1)[-1]
+        stripped = path[2:] if path[:2] in ('a/', 'b/') else path
+        return any(self._match(base if '/' not in x else p, x)
+                   for x in patterns for p in (path, stripped))
+
+    def skipped(self, paths):
+        """Returns whether a diff of given paths is skipped: none of them
+        matches include globs (if any), or all of them match exclude
+        globs"""
+        if not paths:
+            return False
+        if self._include and not any(
+                self._matches(x, self._include) for x in paths):
+            return True
+        return bool(self._exclude) and all(
+            self._matches(x, self._exclude) for x in paths)
+
+
+def _path_filter(opts):
+    """Returns _PathFilter of command line options, or None if not needed"""
+    if not opts.include and not opts.exclude:
+        return None
+    return _PathFilter(opts.include, opts.exclude, opts.summarize_skipped)
+
+
+def _diff_paths(diff):
+    """Returns paths of a diff from diff --git header, which has them without
+    'a/' and 'b/' prefixes, or from path lines, without /dev/null"""
+    paths = set()
+    for line in diff._headers:
+        match = re.match(r'^diff --git a/(.*) b/(.*)$', line.rstrip('\r\n'))
+        if match:
+            paths.update(match.groups())
+    if not paths:
+        for line in (diff._old_path, diff._new_path):
+            if line:
+                paths.add(line[4:].rstrip('\r\n').split('\t')[0])
+        paths.discard('/dev/null')
+    return sorted(paths)
+
+
+def _file_header(headers):
+    """Returns index of the first line in headers of a diff that is about the
+    file, e.g. 'diff --git' or svn 'Index:', lines before it are e.g. commit
+    message"""
+    for i, line in enumerate(headers):
+        if line.startswith(('diff ', 'Index: ', '==== ')):
+            return i
+    return len(headers)
+
+
 class DiffParser:
 
-    def __init__(self, stream):
+    def __init__(self, stream, counted=True, path_filter=None):
         self._stream = stream  # bytes
-
-    def parse(self):
-        """parse all diff lines, construct a list of UnifiedDiff objects"""
+        # Classify lines of a hunk by first byte while it expects more lines
+        # per its hunk meta, instead of trying header heuristics on them.
+        # Only differs in taking '-' * 72 as a deleted line rather than svn
+        # log separator if the hunk expects one more.
+        self._counted = counted
+        self._path_filter = path_filter     # _PathFilter or None
+
+    def parse(self, eager=False):
+        """parse all diff lines, construct a list of UnifiedDiff objects
+
+        If eager is True, hunks are yielded as soon as they are complete
+        (known once next hunk starts) instead of once the whole diff is
+        complete, in UnifiedDiff objects each holding one or more hunks of a
+        diff.  Only the first of them carries headers and paths of the diff,
+        paths of the others are None.  Hunks yielded are not kept, so memory
+        use is bounded by the largest hunk rather than the largest diff.
+        """
         diff = UnifiedDiff([], None, None, [])
         headers = []
+        done = False    # whether a piece of current diff is yielded
+        counted = self._counted
+        old_left = new_left = 0     # lines the hunk expects in counted mode
+        skipping = False    # whether hunks of current diff are skipped
 
         for octets in self._stream:
+            if old_left > 0 or new_left > 0:
+                attr = octets[:1]
+                if attr == b' ':
+                    old_left -= 1
+                    new_left -= 1
+                elif attr == b'-':
+                    old_left -= 1
+                elif attr == b'+':
+                    new_left -= 1
+                else:
+                    attr = None
+                if attr is not None:
+                    if not skipping:
+                        hunk.append(_decode(octets))
+                    continue
+
+            if skipping:
+                # Hunks of a skipped diff are counted by first byte and hunk
+                # meta without decoding or storing them, until next diff
+                match = _HUNK_META_RE.match(octets)
+                if match:
+                    old_left = int(match.group(1) or 1)
+                    new_left = int(match.group(2) or 1)
+                    headers = []    # hunk headers
+                    continue
+                if not octets.startswith((b'--- ', b'Only in ',
+                                          b'Binary files ')):
+                    if not octets.startswith(b'\\ No newline at end of'):
+                        headers.append(_decode(octets))
+                    continue
+                skipping = False
+
             line = _decode(octets)
 
             if diff.is_old_path(line):
@@ -372,108 +997,353 @@ class DiffParser:
                 # line starts with '--- '.
                 if (not diff._hunks or diff._hunks[-1].is_completed()):
                     if diff._old_path and diff._new_path and diff._hunks:
-                        yield diff
+                        yield from self._rest(diff, done)
                     diff = UnifiedDiff(headers, line, None, [])
                     headers = []
+                    done = False
                 else:
-                    diff._hunks[-1].append(diff.parse_hunk_line(line))
+                    diff._hunks[-1].append(line)
 
             elif diff.is_new_path(line) and diff._old_path:
                 if not diff._new_path:
                     diff._new_path = line
+                    if self._skipped(diff):
+                        yield from self._skipped_diff(diff)
+                        diff = UnifiedDiff([], None, None, [])
+                        skipping = True
+                        continue
                 else:
-                    diff._hunks[-1].append(diff.parse_hunk_line(line))
+                    diff._hunks[-1].append(line)
 
             elif diff.is_hunk_meta(line):
                 try:
                     old_addr, new_addr = diff.parse_hunk_meta(line)
                 except (IndexError, ValueError):
                     raise RuntimeError('invalid hunk meta: %s' % line)
+                if eager and diff._old_path and diff._new_path and \
+                        diff._hunks:
+                    # All hunks so far are complete
+                    yield self._piece(diff, done)
+                    diff._hunks = []
+                    done = True
                 diff._hunks.append(Hunk(headers, line, old_addr, new_addr))
                 headers = []
 
             elif diff._hunks and not headers and (diff.is_old(line) or
                                                   diff.is_new(line) or
                                                   diff.is_common(line)):
-                diff._hunks[-1].append(diff.parse_hunk_line(line))
+                diff._hunks[-1].append(line)
 
             elif diff.is_only_in_dir(line) or diff.is_binary_differ(line):
                 # 'Only in foo:' and 'Binary files ... differ' are considered
                 # as separate diffs, so yield current diff, then this line
                 if diff._old_path and diff._new_path and diff._hunks:
                     # Current diff is comppletely constructed
-                    yield diff
+                    yield from self._rest(diff, done)
                 headers.append(line)
-                yield UnifiedDiff(headers, '', '', [])
+                diff = UnifiedDiff(headers, '', '', [])
+                if self._skipped(diff):
+                    yield from self._skipped_diff(diff)
+                else:
+                    yield diff
                 headers = []
                 diff = UnifiedDiff([], None, None, [])
+                done = False
 
             elif not diff.is_eof(line):
                 # Non-recognized lines: headers or hunk headers
                 headers.append(line)
 
+            if counted:
+                hunk, old_left, new_left = self._remaining(diff, headers)
+
         # Validate and yield the last patch set if it is not yielded yet
         if diff._old_path:
             assert diff._new_path is not None
             if diff._hunks:
                 assert len(diff._hunks[-1]._hunk_meta) > 0
                 assert len(diff._hunks[-1]._hunk_list) > 0
-            yield diff
+            yield from self._rest(diff, done)
 
         if headers:
             # Tolerate dangling headers, yield an object with header lines only
             yield UnifiedDiff(headers, '', '', [])
 
+    def _skipped(self, diff):
+        return (self._path_filter is not None and
+                self._path_filter.skipped(_diff_paths(diff)))
+
+    def _skipped_diff(self, diff):
+        """Yields what is left of a skipped diff: headers not about the file
+        (e.g. commit message), and a summary line if asked for"""
+        headers = diff._headers[:_file_header(diff._headers)]
+        if self._path_filter.summary:
+            headers.append('ydiff: skipped %s\n' % ', '.join(
+                _diff_paths(diff)))
+        if headers:
+            yield UnifiedDiff(headers, '', '', [])
+
+    @staticmethod
+    def _remaining(diff, headers):
+        """Returns the last hunk of diff and numbers of old and new lines it
+        expects, which are zero unless lines of it are being parsed"""
+        if not (diff._hunks and diff._old_path and diff._new_path and
+                not headers):
+            return None, 0, 0
+        hunk = diff._hunks[-1]
+        return (hunk, hunk._old_addr[1] - hunk._old_count,
+                hunk._new_addr[1] - hunk._new_count)
+
+    def events(self):
+        """Returns a generator of events: (EVENT_FILE, diff) with headers and
+        paths of a file first, then (EVENT_HUNK, hunk) for each hunk as soon
+        as it is complete, and (EVENT_END, diff) after the last hunk.  The
+        diff holds no hunks, so memory use is bounded by the largest hunk."""
+        diff = None
+        for piece in self.parse(eager=True):
+            if piece._old_path is not None:
+                if diff is not None:
+                    yield EVENT_END, diff
+                diff = UnifiedDiff(piece._headers, piece._old_path,
+                                   piece._new_path, [])
+                yield EVENT_FILE, diff
+            for hunk in piece._hunks:
+                yield EVENT_HUNK, hunk
+        if diff is not None:
+            yield EVENT_END, diff
+
+    @staticmethod
+    def _piece(diff, done):
+        """Returns a UnifiedDiff of hunks of diff not yet yielded, only the
+        first piece of a diff carries its headers and paths"""
+        if not done:
+            return UnifiedDiff(diff._headers, diff._old_path, diff._new_path,
+                               diff._hunks)
+        return UnifiedDiff([], None, None, diff._hunks)
+
+    @classmethod
+    def _rest(cls, diff, done):
+        """Returns what is left to yield of a complete diff"""
+        if not done:
+            return [diff]
+        if diff._hunks:
+            return [cls._piece(diff, done)]
+        return []
+
+
+def _timed(iterable, timers, key):
+    """Yields items of iterable and adds up time spent in getting them to
+    timers[key], time spent by the consumer in between two items does not
+    count."""
+    it = iter(iterable)
+    while True:
+        start = time.monotonic()
+        try:
+            item = next(it)
+        except StopIteration:
+            return
+        finally:
+            timers[key] += time.monotonic() - start
+        yield item
+
 
 class DiffMarker:
 
     def __init__(self, side_by_side=False, width=0, tab_width=8, wrap=False,
-                 theme='default'):
+                 theme='default', word_diff='difflib', max_intraline_lines=0,
+                 render_budget_ms=0, model_cache=None):
         self._side_by_side = side_by_side
         self._width = width
         self._tab_width = tab_width
         self._wrap = wrap
         self._theme = theme
-        self._tint = lambda s, k: _colorize(s, k, theme=theme)
-        colors = set(sum(_all_themes()[theme].values(), []))
-        self._codes = tuple('\x1b[%sm' % c for c in colors)
+        self._word_diff = word_diff
+        self._max_intraline_lines = max_intraline_lines
+        self._render_budget = render_budget_ms / 1000.0
+        self._timers = {'render': 0.0}  # seconds spent in rendering so far
+        self._raw_noticed = False
+        self._model_cache = model_cache
+        self._model_key = None      # key of current diff in model cache
+        self._model = None          # rows of hunks of current diff if cached
+        self._hunk_rows = []        # rows of hunks of current diff so far
+        self._word_memo = collections.OrderedDict()     # in LRU order
+        palette = _Palette(theme)
+        self._tint = palette.colorize
+        self._codes = palette.codes
+        self._wrap_marker = palette.colorize('>', 'wrap_marker')
 
     def markup(self, diff):
         """Returns a generator"""
-        return (self._markup_side_by_side(diff) if self._side_by_side
-                else self._markup_unified(diff))
+        return self.markup_events(diff.events())
+
+    def markup_events(self, events):
+        """Returns a generator of rendered lines of events, as given by
+        DiffParser.events() or UnifiedDiff.events()"""
+        return (self._markup_side_by_side(events) if self._side_by_side
+                else self._markup_unified(events))
+
+    def _timed_hunk(self, lines):
+        """Returns rendered lines of a hunk, timed for render budget if any.
+        Only rendering of hunks is timed, not getting events, which may wait
+        for input."""
+        if self._render_budget:
+            return _timed(lines, self._timers, 'render')
+        return lines
+
+    def _budget_level(self, hunk):
+        """Returns how much rendering of a hunk is cut down to stay within
+        the work budget: 0 for not at all, _DEGRADE_PLAIN if the hunk has more
+        lines than max_intraline_lines, or _DEGRADE_RAW once render budget is
+        spent."""
+        if (self._render_budget and
+                self._timers['render'] > self._render_budget):
+            return _DEGRADE_RAW
+        if self._max_intraline_lines and \
+                len(hunk) > self._max_intraline_lines:
+            return _DEGRADE_PLAIN
+        return 0
+
+    def _markup_degraded(self, hunk, level):
+        """Returns a generator of the notice of degradation followed by hunk
+        lines in unified format, plain colored or raw"""
+        if level == _DEGRADE_RAW:
+            if not self._raw_noticed:
+                self._raw_noticed = True
+                notice = ('ydiff: render budget of %dms exceeded, hunks not '
+                          'colorized from here on\n'
+                          % (self._render_budget * 1000))
+                yield self._tint(notice, 'wrap_marker')
+            yield from hunk._hunk_list
+            return
+
+        yield self._plain_notice()
+        tags = {'-': 'old_line', '+': 'new_line'}
+        for line in hunk._hunk_list:
+            yield self._tint(line, tags.get(line[0], 'common_line'))
+
+    def _begin_model(self, diff):
+        """Looks up rows of hunks of diff in model cache, only diffs that come
+        with their hunks are cached"""
+        self._model_key = self._model = None
+        self._hunk_rows = []
+        if self._model_cache and diff._hunks:
+            # Word diff works on normalized lines in side-by-side mode
+            opts = (self._side_by_side, self._side_by_side and self._tab_width,
+                    self._word_diff, self._max_intraline_lines)
+            self._model_key = self._model_cache.key(diff, opts)
+            self._model = self._model_cache.load(self._model_key)
+
+    def _end_model(self):
+        """Saves rows of hunks of current diff to model cache if they are
+        computed and complete"""
+        if self._model_key and self._model is None and \
+                None not in self._hunk_rows:
+            self._model_cache.save(self._model_key, self._hunk_rows)
+        self._model_key = self._model = None
+        self._hunk_rows = []
+
+    def _rows(self, hunk, level):
+        """Returns rows of hunk as (old, new, changed, words) tuples, where
+        old, new and changed are as of Hunk.mdiff(), words are texts of a line
+        changed on both sides as returned by _word_diff(), or None."""
+        if not self._model_key:
+            return self._compute_rows(hunk, level)
+        if self._model is not None:
+            rows = self._model[len(self._hunk_rows)]
+        else:
+            rows = list(self._compute_rows(hunk, level))
+        self._hunk_rows.append(rows)
+        return rows
+
+    def _compute_rows(self, hunk, level):
+        if level == _DEGRADE_PLAIN:
+            rows = _pair_in_order(hunk._hunk_list)
+        else:
+            rows = hunk.mdiff()
+        for old, new, changed in rows:
+            words = None
+            if changed and old[0] and new[0] and level != _DEGRADE_PLAIN:
+                if self._side_by_side:
+                    words = self._diff_words(self._normalize(old[1]),
+                                             self._normalize(new[1]))
+                else:
+                    words = self._diff_words(old[1], new[1])
+            yield old, new, changed, words
+
+    def _diff_words(self, a, b):
+        """Returns _word_diff() of a pair of lines, the same pairs recur often
+        in logs (cherry-picks, reverts, the same change in many files) so the
+        results of recent pairs are remembered."""
+        memo = self._word_memo
+        key = (a, b)
+        words = memo.get(key)
+        if words is None:
+            words = memo[key] = _word_diff(a, b, self._word_diff)
+            if len(memo) > _WORD_MEMO_SIZE:
+                memo.popitem(last=False)
+        else:
+            memo.move_to_end(key)
+        return words
+
+    def _skip_rows(self):
+        """Notes that rows of a hunk are not computed, e.g. rendered raw"""
+        if self._model_key:
+            self._hunk_rows.append(self._model[len(self._hunk_rows)]
+                                   if self._model is not None else None)
 
-    def _markup_unified(self, diff):
+    def _plain_notice(self):
+        return self._tint('ydiff: hunk has more than %d lines, changed words '
+                          'not highlighted\n' % self._max_intraline_lines,
+                          'wrap_marker')
+
+    def _markup_header(self, diff):
         """Returns a generator"""
         yield from (self._tint(x, 'header') for x in diff._headers)
-        yield self._tint(diff._old_path, 'old_path')
-        yield self._tint(diff._new_path, 'new_path')
+        if diff._old_path is not None:
+            yield self._tint(diff._old_path, 'old_path')
+            yield self._tint(diff._new_path, 'new_path')
 
-        for hunk in diff._hunks:
-            yield from (self._tint(x, 'hunk_header')
-                        for x in hunk._hunk_headers)
-            yield self._tint(hunk._hunk_meta, 'hunk_meta')
-            for old, new, changed in hunk.mdiff():
-                if changed:
-                    if not old[0]:
-                        # The '+' char after \0 is kept
-                        # DEBUG: yield 'NEW: %s %s\n' % (old, new)
-                        line = new[1].strip('\0\1')
-                        yield self._tint(line, 'new_line')
-                    elif not new[0]:
-                        # The '-' char after \0 is kept
-                        # DEBUG: yield 'OLD: %s %s\n' % (old, new)
-                        line = old[1].strip('\0\1')
-                        yield self._tint(line, 'old_line')
-                    else:
-                        # DEBUG: yield 'CHG: %s %s\n' % (old, new)
-                        a, b = _word_diff(old[1], new[1])
-                        yield (self._tint('-', 'old_line') +
-                               self._tint(a, 'replaced_old_text'))
-                        yield (self._tint('+', 'new_line') +
-                               self._tint(b, 'replaced_new_text'))
+    def _markup_unified(self, events):
+        """Returns a generator"""
+        for kind, item in events:
+            if kind == EVENT_FILE:
+                self._begin_model(item)
+                yield from self._markup_header(item)
+            elif kind == EVENT_HUNK:
+                yield from self._timed_hunk(self._markup_unified_hunk(item))
+            else:
+                self._end_model()
+
+    def _markup_unified_hunk(self, hunk):
+        """Returns a generator"""
+        yield from (self._tint(x, 'hunk_header') for x in hunk._hunk_headers)
+        yield self._tint(hunk._hunk_meta, 'hunk_meta')
+        level = self._budget_level(hunk)
+        if level:
+            self._skip_rows()
+            yield from self._markup_degraded(hunk, level)
+            return
+        for old, new, changed, words in self._rows(hunk, level):
+            if changed:
+                if not old[0]:
+                    # The '+' char after \0 is kept
+                    # DEBUG: yield 'NEW: %s %s\n' % (old, new)
+                    line = new[1].strip('\0\1')
+                    yield self._tint(line, 'new_line')
+                elif not new[0]:
+                    # The '-' char after \0 is kept
+                    # DEBUG: yield 'OLD: %s %s\n' % (old, new)
+                    line = old[1].strip('\0\1')
+                    yield self._tint(line, 'old_line')
                 else:
-                    yield self._tint(' ' + old[1], 'common_line')
+                    # DEBUG: yield 'CHG: %s %s\n' % (old, new)
+                    a, b = words
+                    yield (self._tint('-', 'old_line') +
+                           self._tint(a, 'replaced_old_text'))
+                    yield (self._tint('+', 'new_line') +
+                           self._tint(b, 'replaced_new_text'))
+            else:
+                yield self._tint(' ' + old[1], 'common_line')
 
     def _normalize(self, line):
         while True:
@@ -487,18 +1357,41 @@ class DiffMarker:
             line = line[:idx] + ' ' * width + line[idx + 1:]
         return line.replace('\n', '').replace('\r', '')
 
-    def _markup_side_by_side(self, diff):
+    def _markup_side_by_side(self, events):
         """Returns a generator"""
-        # Set up number width, note last hunk might be empty
-        try:
-            (start, offset) = diff._hunks[-1]._old_addr
-            max1 = start + offset - 1
-            (start, offset) = diff._hunks[-1]._new_addr
-            max2 = start + offset - 1
-        except IndexError:
-            max1 = max2 = 0
-        num_width = max(len(str(max1)), len(str(max2)))
-
+        for kind, item in events:
+            if kind == EVENT_FILE:
+                # Line numbers of the last hunk set the width of line number
+                # columns if the diff comes with its hunks (note last hunk
+                # might be empty), otherwise the width grows with hunks
+                grow = not item._hunks
+                if not grow:
+                    num_width = self._num_width(item._hunks[-1])
+                    layout = self._layout(num_width)
+                else:
+                    num_width = 0
+                self._begin_model(item)
+                yield from self._markup_header(item)
+            elif kind == EVENT_HUNK:
+                if grow and self._num_width(item) > num_width:
+                    num_width = self._num_width(item)
+                    layout = self._layout(num_width)
+                yield from self._timed_hunk(
+                    self._markup_side_by_side_hunk(item, *layout))
+            else:
+                self._end_model()
+
+    @staticmethod
+    def _num_width(hunk):
+        """Returns number of digits of the largest line number in hunk"""
+        (start, offset) = hunk._old_addr
+        max1 = start + offset - 1
+        (start, offset) = hunk._new_addr
+        max2 = start + offset - 1
+        return max(len(str(max1)), len(str(max2)))
+
+    def _layout(self, num_width):
+        """Returns text width and line format for given line number width"""
         # Set up line width
         width = self._width
         if width <= 0:
@@ -513,90 +1406,561 @@ class DiffMarker:
                               'new_line_number')
         line_fmt = (num_fmt1 + ' %(left)s ' + _RESET +
                     num_fmt2 + ' %(right)s\n')
+        return width, line_fmt
 
-        yield from (self._tint(x, 'header') for x in diff._headers)
-        yield self._tint(diff._old_path, 'old_path')
-        yield self._tint(diff._new_path, 'new_path')
-
-        for hunk in diff._hunks:
-            for hunk_header in hunk._hunk_headers:
-                yield self._tint(hunk_header, 'hunk_header')
-            yield self._tint(hunk._hunk_meta, 'hunk_meta')
-            for old, new, changed in hunk.mdiff():
-                left_num, right_num = ' ', ' '
-                if old[0]:
-                    left_num = str(hunk._old_addr[0] + int(old[0]) - 1)
-                if new[0]:
-                    right_num = str(hunk._new_addr[0] + int(new[0]) - 1)
-
-                left, right = self._normalize(old[1]), self._normalize(new[1])
-                if changed:
-                    if not old[0]:
-                        left = ''
-                        right = right.rstrip('\1')
-                        if right.startswith('\0+'):
-                            right = right[2:]
-                        right = self._tint(right, 'new_line')
-                    elif not new[0]:
-                        left = left.rstrip('\1')
-                        if left.startswith('\0-'):
-                            left = left[2:]
-                        left = self._tint(left, 'old_line')
-                        right = ''
-                    else:
-                        left, right = _word_diff(left, right)
-                        left = self._tint(left, 'replaced_old_text')
-                        right = self._tint(right, 'replaced_new_text')
-                else:
-                    left = self._tint(left, 'common_line')
-                    right = self._tint(right, 'common_line')
-
-                if self._wrap:
-                    # Need to wrap long lines, so here we'll iterate,
-                    # shaving off `width` chars from both left and right
-                    # strings, until both are empty. Also, line number needs to
-                    # be printed only for the first part.
-                    lncur = left_num
-                    rncur = right_num
-                    while left or right:
-                        # Split both left and right lines, preserving escaping
-                        # sequences correctly.
-                        lcur, left, llen = _strsplit(left, width, self._codes)
-                        rcur, right, _ = _strsplit(right, width, self._codes)
-
-                        # Pad left line with spaces if needed
-                        if llen < width:
-                            lcur += ' ' * (width - llen)
-
-                        yield line_fmt % {
-                            'left_num': lncur,
-                            'left': lcur,
-                            'right_num': rncur,
-                            'right': rcur
-                        }
-
-                        # Clean line numbers for further iterations
-                        lncur = ''
-                        rncur = ''
+    def _markup_side_by_side_hunk(self, hunk, width, line_fmt):
+        """Returns a generator"""
+        for hunk_header in hunk._hunk_headers:
+            yield self._tint(hunk_header, 'hunk_header')
+        yield self._tint(hunk._hunk_meta, 'hunk_meta')
+        level = self._budget_level(hunk)
+        if level == _DEGRADE_RAW:
+            self._skip_rows()
+            yield from self._markup_degraded(hunk, level)
+            return
+        if level == _DEGRADE_PLAIN:
+            yield self._plain_notice()
+        for old, new, changed, words in self._rows(hunk, level):
+            left_num, right_num = ' ', ' '
+            if old[0]:
+                left_num = str(hunk._old_addr[0] + int(old[0]) - 1)
+            if new[0]:
+                right_num = str(hunk._new_addr[0] + int(new[0]) - 1)
+
+            if words:
+                left, right = words
+            else:
+                left = self._normalize(old[1])
+                right = self._normalize(new[1])
+            if changed:
+                if not old[0]:
+                    left = ''
+                    right = right.rstrip('\1')
+                    if right.startswith('\0+'):
+                        right = right[2:]
+                    right = self._tint(right, 'new_line')
+                elif not new[0]:
+                    left = left.rstrip('\1')
+                    if left.startswith('\0-'):
+                        left = left[2:]
+                    left = self._tint(left, 'old_line')
+                    right = ''
+                elif level == _DEGRADE_PLAIN:
+                    # Both are marked as a whole, strip markers and attr
+                    left = self._tint(left.rstrip('\1')[2:], 'old_line')
+                    right = self._tint(right.rstrip('\1')[2:], 'new_line')
                 else:
-                    # Don't need to wrap long lines; instead, a trailing '>'
-                    # char needs to be appended.
-                    wrap_marker = self._tint('>', 'wrap_marker')
-                    left = _strtrim(left, width, wrap_marker, len(right) > 0,
-                                    self._codes)
-                    right = _strtrim(right, width, wrap_marker, False,
-                                     self._codes)
+                    left = self._tint(left, 'replaced_old_text')
+                    right = self._tint(right, 'replaced_new_text')
+            else:
+                left = self._tint(left, 'common_line')
+                right = self._tint(right, 'common_line')
+
+            if self._wrap:
+                # Need to wrap long lines, so here we'll split both left
+                # and right strings into `width` chars pieces, preserving
+                # escaping sequences correctly, and lay them out in rows.
+                # Also, line number needs to be printed only for the
+                # first row.
+                lncur = left_num
+                rncur = right_num
+                for (lcur, llen), (rcur, _) in itertools.zip_longest(
+                        _strwrap(left, width, self._codes),
+                        _strwrap(right, width, self._codes),
+                        fillvalue=('', 0)):
+                    # Pad left line with spaces if needed
+                    if llen < width:
+                        lcur += ' ' * (width - llen)
 
                     yield line_fmt % {
-                        'left_num': left_num,
-                        'left': left,
-                        'right_num': right_num,
-                        'right': right
+                        'left_num': lncur,
+                        'left': lcur,
+                        'right_num': rncur,
+                        'right': rcur
                     }
 
+                    # Clean line numbers for further iterations
+                    lncur = ''
+                    rncur = ''
+            else:
+                # Don't need to wrap long lines; instead, a trailing '>'
+                # char needs to be appended.
+                left = _strtrim(left, width, self._wrap_marker,
+                                len(right) > 0, self._codes)
+                right = _strtrim(right, width, self._wrap_marker, False,
+                                 self._codes)
+
+                yield line_fmt % {
+                    'left_num': left_num,
+                    'left': left,
+                    'right_num': right_num,
+                    'right': right
+                }
+
+
+class _Pipeline:
+    """Runs a chain of stages on separate threads joined by bounded queues.
+
+    Each stage is a function taking an iterable and returning an iterable, the
+    first one is fed with the source and the output of the last one is
+    consumed by iterating the pipeline object on the calling thread.  Items
+    travel between threads in batches to keep the locking overhead low, a
+    partial batch is handed over as soon as a stage is about to wait for more
+    input.
+
+    Time each stage spent blocked is recorded in ``blocked`` as a list of
+    (name, waiting for input, waiting for output) entries, where waiting for
+    input of the first stage is time spent reading the source.
+    """
+
+    _DONE = object()
+
+    def __init__(self, source, stages, depth=_PIPELINE_DEPTH,
+                 batch=_PIPELINE_BATCH):
+        import queue
+        import threading
+
+        self._batch = batch
+        self._closed = False
+        self.blocked = [[name, 0.0, 0.0] for name, _ in stages]
+        self._queues = [queue.Queue(depth) for _ in stages]
+        self._threads = []
+        inputs = [None] + self._queues[:-1]
+        for i, (_, fn) in enumerate(stages):
+            thread = threading.Thread(
+                target=self._run, args=(i, fn, source, inputs[i]))
+            thread.daemon = True
+            self._threads.append(thread)
+        for thread in self._threads:
+            thread.start()
+
+    def _run(self, index, fn, source, inq):
+        outq, pending = self._queues[index], []
+        stats = self.blocked[index]
+
+        def flush():
+            if pending:
+                self._put(outq, list(pending), stats)
+                del pending[:]
+
+        def inputs():
+            if inq is None:
+                it = iter(source)
+                while True:
+                    start = time.monotonic()
+                    try:
+                        item = next(it)
+                    except StopIteration:
+                        return
+                    finally:
+                        stats[1] += time.monotonic() - start
+                    yield item
+            while True:
+                if inq.empty():
+                    flush()
+                start = time.monotonic()
+                items = self._get(inq)
+                stats[1] += time.monotonic() - start
+                if items is self._DONE:
+                    return
+                if isinstance(items, BaseException):
+                    raise items
+                yield from items
+
+        try:
+            for item in fn(inputs()):
+                pending.append(item)
+                if len(pending) >= self._batch:
+                    flush()
+            flush()
+            self._put(outq, self._DONE, stats)
+        except BaseException as e:
+            self._put(outq, e, stats)
+
+    def _get(self, inq):
+        import queue
+
+        while not self._closed:
+            try:
+                return inq.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        return self._DONE
+
+    def _put(self, outq, items, stats):
+        import queue
+
+        start = time.monotonic()
+        try:
+            while not self._closed:
+                try:
+                    outq.put(items, timeout=0.1)
+                    return
+                except queue.Full:
+                    pass
+        finally:
+            stats[2] += time.monotonic() - start
+
+    def __iter__(self):
+        outq = self._queues[-1]
+        while True:
+            items = outq.get()
+            if items is self._DONE:
+                return
+            if isinstance(items, BaseException):
+                raise items
+            yield from items
+
+    def close(self):
+        """Tells all stages to stop, e.g. when the consumer gives up.  A stage
+        blocked on reading the source is left behind as a daemon thread."""
+        self._closed = True
+
+
+class _NonBlockingIO:
+    """Reads lines from an input pipe and writes to the pager pipe on one
+    thread, with both fds in non-blocking mode and multiplexed by a selector.
+
+    While the caller waits for input, pending output is written to the pager,
+    and while the pager is not ready for more, input is read ahead.  Both are
+    bounded by limit bytes: write() holds up the caller (i.e. rendering) once
+    that much output is pending, which is the backpressure from the pager.
+    """
+
+    def __init__(self, infd, outfd, limit=_NONBLOCKING_LIMIT):
+        import fcntl
+        import selectors
+
+        self._infd, self._outfd = infd, outfd
+        self._flags = []
+        for fd in (infd, outfd):
+            flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+            self._flags.append((fd, flags))
+            fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+        self._selector = selectors.DefaultSelector()
+        self._read_event = selectors.EVENT_READ
+        self._write_event = selectors.EVENT_WRITE
+        self._limit = limit
+        self._lines = collections.deque()
+        self._ahead = 0         # bytes in self._lines and self._tail
+        self._tail = []         # chunks of incomplete last line read so far
+        self._eof = False
+        self._out = bytearray()
+
+    def __iter__(self):
+        lines = self._lines
+        while True:
+            while lines:
+                line = lines.popleft()
+                self._ahead -= len(line)
+                yield line
+            if self._eof:
+                if self._tail:
+                    self._ahead = 0
+                    yield b''.join(self._tail)
+                    self._tail = []
+                return
+            self._poll()
+
+    def write(self, data):
+        self._out += data
+        while len(self._out) > self._limit:
+            self._poll()
+
+    def flush(self):
+        while self._out:
+            self._poll()
+
+    def _poll(self):
+        """Waits until input can be read or output can be written, and does
+        so"""
+        events = {}
+        # A line longer than limit is still read to its end
+        if not self._eof and (self._ahead < self._limit or not self._lines):
+            events[self._infd] = self._read_event
+        if self._out:
+            events[self._outfd] = self._write_event
+        if not events:
+            return
+        selector = self._selector
+        for fd, event in events.items():
+            selector.register(fd, event)
+        try:
+            ready = selector.select()
+        finally:
+            for fd in events:
+                selector.unregister(fd)
+        for key, _ in ready:
+            if key.fd == self._infd:
+                self._read()
+            else:
+                self._write()
+
+    def _read(self):
+        try:
+            data = os.read(self._infd, _WRITE_BUFFER)
+        except BlockingIOError:
+            return
+        if not data:
+            self._eof = True
+            return
+        self._ahead += len(data)
+        # Only new data is searched and a long line is joined once complete,
+        # so reading it takes linear time
+        cut = data.rfind(b'\n') + 1
+        if not cut:
+            self._tail.append(data)
+            return
+        if self._tail:
+            self._tail.append(data[:cut])
+            lines = _split_lines(b''.join(self._tail))
+        else:
+            lines = _split_lines(data[:cut])
+        self._lines.extend(lines)
+        self._tail = [data[cut:]] if cut < len(data) else []
+
+    def _write(self):
+        try:
+            written = os.write(self._outfd, self._out[:_WRITE_BUFFER])
+        except BlockingIOError:
+            return
+        del self._out[:written]
+
+    def close(self):
+        """Puts fds back to blocking mode"""
+        import fcntl
+
+        self._selector.close()
+        for fd, flags in self._flags:
+            with contextlib.suppress(OSError):
+                fcntl.fcntl(fd, fcntl.F_SETFL, flags)
+
+
+def _nonblocking_io(stream, out):
+    """Returns a _NonBlockingIO reading stream and writing out if stream is
+    a pipe and the platform supports it, otherwise None"""
+    try:
+        infd = stream.fileno()
+        if not stat.S_ISFIFO(os.fstat(infd).st_mode):
+            return None
+        return _NonBlockingIO(infd, out.fileno())
+    except (AttributeError, ImportError, OSError, ValueError):
+        # No fileno() or fcntl (not a Unix-like system)
+        return None
+
+
+def _markup_diffs(marker, diffs, separator):
+    """Returns a generator of rendered lines for all diffs, with a separator
+    line between two diffs."""
+    with contextlib.suppress(StopIteration):
+        # Fetch one diff first, output a separation line for the rest, if any.
+        # More hunks of the same diff parsed in eager mode have no path.
+        yield from marker.markup(next(diffs))
+        for diff in diffs:
+            if diff._old_path is not None:
+                yield separator
+            yield from marker.markup(diff)
+
+
+def _markup_events(marker, events, separator):
+    """Same as _markup_diffs() but renders events of DiffParser.events()"""
+    events = iter(events)
+    for i, event in enumerate(events):
+        # Always an EVENT_FILE event here
+        if i > 0 and event[1]._old_path is not None:
+            yield separator
+        yield from marker.markup_events(_file_events(event, events))
+
+
+def _file_events(event, events):
+    """Yields event, then events up to and including the end of the file"""
+    yield event
+    for event in events:
+        yield event
+        if event[0] == EVENT_END:
+            return
+
+
+def _markup_diffs_parallel(marker_opts, diffs, separator, jobs):
+    """Same as _markup_diffs() but renders diffs in a pool of worker processes.
+    Yields rendered diffs in original order, at most a few diffs per worker
+    are in flight so memory stays flat, and a diff is yielded as soon as it
+    and all diffs before it are done."""
+    import concurrent.futures
+
+    jobs = jobs or os.cpu_count() or 1
+    window, pending = jobs * _JOBS_WINDOW, []
+    with concurrent.futures.ProcessPoolExecutor(jobs) as executor:
+        try:
+            for i, diff in enumerate(diffs):
+                new_path = i > 0 and diff._old_path is not None
+                pending.append((new_path, executor.submit(
+                    _markup_diff_worker, marker_opts, diff)))
+                while pending and (len(pending) >= window or
+                                   pending[0][1].done()):
+                    new_path, future = pending.pop(0)
+                    if new_path:
+                        yield separator
+                    yield future.result()
+            for new_path, future in pending:
+                if new_path:
+                    yield separator
+                yield future.result()
+        finally:
+            for _, future in pending:
+                future.cancel()
+
+
+_WORKER_MARKERS = {}
+
+
+def _markup_diff_worker(marker_opts, diff):
+    """Renders one diff in a worker process, returns all lines joined."""
+    key = tuple(sorted(marker_opts.items()))
+    if key not in _WORKER_MARKERS:
+        _WORKER_MARKERS[key] = DiffMarker(**marker_opts)
+    return ''.join(_WORKER_MARKERS[key].markup(diff))
+
+
+class _Stats:
+    """Counters and timers of a run for --stats.
+
+    Timers are hooked up by wrapping module level functions and methods in
+    install(), so nothing is measured nor slowed down unless stats are asked
+    for.  Nested timers are inclusive: time spent in parsing includes reading
+    input, which is subtracted in the report.  With --jobs, time spent in
+    rendering by worker processes is not collected.
+    """
+
+    COUNTERS = ('bytes_read', 'lines_read', 'diffs', 'hunks', 'changed_pairs',
+                'word_diff_hits', 'word_diff_misses')
+    TIMERS = ('read', 'parse', 'mdiff', 'word_diff', 'colorize', 'split',
+              'write')
+
+    def __init__(self):
+        self.start = time.monotonic()
+        self.counters = dict.fromkeys(self.COUNTERS, 0)
+        self.timers = dict.fromkeys(self.TIMERS, 0.0)
+        self.first_byte = None
+        self.blocked = []   # filled in by _pipeline_to_pager()
+        self._saved = []
+
+    def install(self):
+        module = sys.modules[__name__]
+        self._wrap(module, '_word_diff', self._timed_call, 'word_diff')
+        self._wrap(DiffMarker, '_diff_words', self._counted_memo)
+        self._wrap(module, '_strsplit', self._timed_call, 'split')
+        self._wrap(module, '_strtrim', self._timed_call, 'split')
+        self._wrap(module, '_strwrap', self._timed_iter, 'split')
+        self._wrap(_Palette, 'colorize', self._timed_call, 'colorize')
+        self._wrap(Hunk, 'mdiff', self._timed_iter, 'mdiff')
+        self._wrap(DiffParser, 'parse', self._timed_parse, 'parse')
+
+    def uninstall(self):
+        while self._saved:
+            owner, name, orig = self._saved.pop()
+            setattr(owner, name, orig)
+
+    def _wrap(self, owner, name, wrapper, *args):
+        orig = getattr(owner, name)
+        if isinstance(owner, type):
+            orig = owner.__dict__[name]     # unbound, to be bound again
+        self._saved.append((owner, name, orig))
+        setattr(owner, name, wrapper(orig, *args))
+
+    def _timed_call(self, fn, key, counter=None):
+        timers, counters = self.timers, self.counters
+
+        def wrapper(*args, **kwargs):
+            if counter:
+                counters[counter] += 1
+            start = time.monotonic()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                timers[key] += time.monotonic() - start
+        return wrapper
+
+    def _counted_memo(self, fn):
+        counters = self.counters
+
+        def wrapper(marker, a, b):
+            counters['changed_pairs'] += 1
+            if (a, b) in marker._word_memo:
+                counters['word_diff_hits'] += 1
+            else:
+                counters['word_diff_misses'] += 1
+            return fn(marker, a, b)
+        return wrapper
+
+    def _timed_iter(self, fn, key):
+        def wrapper(*args, **kwargs):
+            return _timed(fn(*args, **kwargs), self.timers, key)
+        return wrapper
+
+    def _timed_parse(self, fn, key):
+        counters = self.counters
+
+        def wrapper(parser, *args, **kwargs):
+            for diff in _timed(fn(parser, *args, **kwargs), self.timers, key):
+                # Pieces of a diff parsed in eager mode come without path
+                counters['diffs'] += diff._old_path is not None
+                counters['hunks'] += len(diff._hunks)
+                yield diff
+        return wrapper
+
+    def read(self, stream):
+        """Returns a generator of lines in stream, counted and timed"""
+        counters = self.counters
+        for line in _timed(stream, self.timers, 'read'):
+            counters['lines_read'] += 1
+            counters['bytes_read'] += len(line)
+            yield line
+
+    def write(self, fn):
+        """Returns a wrapper of write (or flush) function fn, timed and noting
+        down when the first byte was written"""
+        timed_fn = self._timed_call(fn, 'write')
+
+        def wrapper(*args):
+            timed_fn(*args)
+            if self.first_byte is None:
+                self.first_byte = time.monotonic() - self.start
+        return wrapper
+
+    def report(self, fmt='text'):
+        """Returns the summary in 'text' or 'json' format"""
+        timers = dict(self.timers)
+        timers['parse'] = max(timers['parse'] - timers['read'], 0.0)
+        timers['first_byte'] = self.first_byte or 0.0
+        timers['total'] = time.monotonic() - self.start
+        if fmt == 'json':
+            import json
+            return json.dumps({
+                'counters': self.counters,
+                'timers': {k: round(v, 6) for k, v in timers.items()},
+                'blocked': {name: {'input': round(wait_in, 6),
+                                   'output': round(wait_out, 6)}
+                            for name, wait_in, wait_out in self.blocked},
+            }, sort_keys=True) + '\n'
+
+        lines = [
+            'ydiff: %s\n' % ', '.join(
+                '%s %d' % (k, self.counters[k]) for k in self.COUNTERS),
+            'ydiff: time %s\n' % ', '.join(
+                '%s %.3fs' % (k, timers[k])
+                for k in self.TIMERS + ('first_byte', 'total')),
+        ]
+        if self.blocked:
+            lines.append('ydiff: blocked on input/output: %s\n' % ', '.join(
+                '%s %.2fs/%.2fs' % tuple(x) for x in self.blocked))
+        return ''.join(lines)
+
 
 def markup_to_pager(stream, opts):
     """Pipe unified diff stream (in bytes) to pager (less)."""
+    import subprocess
+
     pager_cmd = [opts.pager]
     pager_opts = opts.pager_options.split(' ') if opts.pager_options else []
 
@@ -610,68 +1974,814 @@ def markup_to_pager(stream, opts):
     pager = subprocess.Popen(
         pager_cmd, stdin=subprocess.PIPE, stdout=sys.stdout)
 
-    marker = DiffMarker(side_by_side=opts.side_by_side, width=opts.width,
-                        tab_width=opts.tab_width, wrap=opts.wrap,
-                        theme=opts.theme)
+    nonblocking = None
+    if opts.nonblocking and not opts.pipeline:
+        nonblocking = _nonblocking_io(stream, pager.stdin)
+        if nonblocking:
+            stream = nonblocking
+
+    stats = None
+    if opts.stats:
+        stats = _Stats()
+        stats.install()
+        stream = stats.read(stream)
+    try:
+        _markup_to_pager(stream, opts, pager, stats, nonblocking)
+    finally:
+        if stats:
+            stats.uninstall()
+        if nonblocking:
+            nonblocking.close()
+
+    with contextlib.suppress(BrokenPipeError):
+        pager.stdin.close()
+    pager.wait()
+
+    if stats:
+        sys.stderr.write(stats.report(opts.stats))
+
+
+def _marker_opts(opts, model_cache=None):
+    """Returns keyword arguments of DiffMarker from command line options"""
+    return dict(side_by_side=opts.side_by_side, width=opts.width,
+                tab_width=opts.tab_width, wrap=opts.wrap, theme=opts.theme,
+                word_diff=opts.word_diff,
+                max_intraline_lines=opts.max_intraline_lines,
+                render_budget_ms=opts.render_budget_ms,
+                model_cache=model_cache)
+
+
+def builtin_pager(stream, opts):
+    """Shows unified diff stream (in bytes) in built-in pager, or pipes it to
+    external pager if there is no terminal to read keys from."""
+    try:
+        tty = open('/dev/tty', 'rb', buffering=0)
+    except OSError:
+        markup_to_pager(stream, opts)
+        return
+    with tty:
+        parser = DiffParser(stream, path_filter=_path_filter(opts))
+        pager = _BuiltinPager(parser.events(), _marker_opts(opts))
+        pager.run(tty, getattr(sys.stdout, 'buffer', sys.stdout))
+
+
+def _markup_to_pager(stream, opts, pager, stats, nonblocking=None):
+
+    model_cache = None
+    if opts.cache:
+        model_cache = _ModelCache(opts.cache_size * 1024 * 1024)
+    marker_opts = _marker_opts(opts, model_cache)
+    path_filter = _path_filter(opts)
     term_width = _terminal_width()
     separator = _colorize('─' * (term_width - 1) + '\n', 'file_separator',
                           theme=opts.theme)
-    diffs = DiffParser(stream).parse()
 
-    with contextlib.suppress(StopIteration, BrokenPipeError):
-        # Fetch one diff first, output a separation line for the rest, if any.
-        diff = next(diffs)
-        for line in marker.markup(diff):
-            pager.stdin.write(line.encode('utf-8'))
-        for diff in diffs:
-            pager.stdin.write(separator.encode('utf-8'))
-            for line in marker.markup(diff):
-                pager.stdin.write(line.encode('utf-8'))
+    if opts.jobs != 1:
+        def parse(lines):
+            return DiffParser(lines, path_filter=path_filter).parse(
+                eager=opts.low_latency)
 
-    with contextlib.suppress(BrokenPipeError):
-        pager.stdin.close()
-    pager.wait()
+        def render(diffs):
+            return _markup_diffs_parallel(marker_opts, diffs, separator,
+                                          opts.jobs)
+    elif opts.low_latency:
+        # Stream hunks one by one, so memory is bounded by the largest hunk
+        marker = DiffMarker(**marker_opts)
+
+        def parse(lines):
+            return DiffParser(lines, path_filter=path_filter).events()
 
+        def render(events):
+            return _markup_events(marker, events, separator)
+    else:
+        marker = DiffMarker(**marker_opts)
+
+        def parse(lines):
+            return DiffParser(lines, path_filter=path_filter).parse()
+
+        def render(diffs):
+            return _markup_diffs(marker, diffs, separator)
+
+    write, flush = pager.stdin.write, pager.stdin.flush
+    if nonblocking:
+        write, flush = nonblocking.write, nonblocking.flush
+    if stats:
+        write, flush = stats.write(write), stats.write(flush)
+    out = _PagerWriter(write, flush, opts.buffer_size)
 
-# Keys for revision control probe, diff and log (optional) with diff
+    if opts.pipeline:
+        _pipeline_to_pager(stream, parse, render, out, stats)
+    else:
+        diffs = parse(stream)
+        with contextlib.suppress(BrokenPipeError):
+            if opts.low_latency:
+                # Writer is flushed while rendering, write line by line
+                for line in render(_flushing(diffs, out)):
+                    out.write(line)
+            else:
+                out.writelines(render(diffs))
+            out.flush()
+
+    if model_cache:
+        model_cache.prune()
+
+
+def _flushing(diffs, out):
+    """Yields diffs (or events), flushes what's written to out (if it's still
+    the first screen) before fetching next one which might wait on input"""
+    for diff in diffs:
+        yield diff
+        out.flush_early()
+
+
+class _PagerWriter:
+    """Collects rendered lines and writes them to pager encoded in chunks of
+    about buffer_size bytes, instead of one write per line.  The first screen
+    of lines is written and flushed as soon as it's ready, so the pager can
+    show something right away."""
+
+    def __init__(self, write, flush, buffer_size=_WRITE_BUFFER,
+                 first_screen=None):
+        self._write = write     # takes bytes
+        self._flush = flush
+        self._buffer_size = buffer_size
+        self._lines = []
+        self._pending = 0       # number of chars in _lines
+        # Number of lines to write before first screen is complete
+        self._first_screen = first_screen or _terminal_height()
+
+    def write(self, text):
+        self.writelines((text,))
+
+    def writelines(self, lines):
+        """Same as write() for each line, lines must not be produced by code
+        writing to or flushing this writer"""
+        buf, pending = self._lines, self._pending
+        for text in lines:
+            buf.append(text)
+            pending += len(text)
+            if pending >= self._buffer_size:
+                self._write_lines()
+                buf, pending = self._lines, 0
+            elif self._first_screen and len(buf) >= self._first_screen:
+                self.flush()
+                buf, pending = self._lines, 0
+        self._pending = pending
+
+    def flush(self):
+        self._first_screen = max(self._first_screen - len(self._lines), 0)
+        self._write_lines()
+        self._flush()
+
+    def flush_early(self):
+        """Flushes pending lines if the first screen is not complete yet, so
+        that they show up before waiting for more input"""
+        if self._first_screen:
+            self.flush()
+
+    def _write_lines(self):
+        if self._lines:
+            data = ''.join(self._lines).encode('utf-8')
+            self._lines = []
+            self._pending = 0
+            self._write(data)
+
+
+class _BuiltinPager:
+    """Pager that renders only what is shown, for --builtin-pager.
+
+    Input is parsed as far as needed to fill the screen, into units of either
+    headers of a file or a hunk.  Only units on screen are rendered, and lines
+    of recently rendered units are kept.  When the terminal is resized, units
+    are rendered again at new width without parsing again.  Each rendered
+    line takes one row, long lines are cut by the terminal.
+    """
+
+    def __init__(self, events, marker_opts):
+        self._events = iter(events)
+        self._marker = DiffMarker(**dict(marker_opts, model_cache=None))
+        self._theme = marker_opts.get('theme', 'default')
+        self._units = []        # (diff, hunk or None, line number width)
+        self._files = []        # index of header unit of each file
+        self._done = False      # whether all input is parsed
+        self._rendered = collections.OrderedDict()  # in LRU order
+        self._top = (0, 0)      # unit and line in it at top of screen
+        self._width = self._height = 0
+        self._separator = None
+
+    def resize(self, width, height):
+        self._width, self._height = width, height
+        self._separator = _colorize('─' * (width - 1) + '\n',
+                                    'file_separator', theme=self._theme)
+        self._rendered.clear()
+        self._move(0)
+
+    def _parse(self, count):
+        """Parses input until there are count units, returns whether there
+        are"""
+        units = self._units
+        while len(units) < count and not self._done:
+            event = next(self._events, None)
+            if event is None:
+                self._done = True
+            elif event[0] == EVENT_FILE:
+                self._files.append(len(units))
+                units.append((event[1], None, 0))
+            elif event[0] == EVENT_HUNK:
+                diff, _, num_width = units[-1]
+                units.append((diff, event[1],
+                              max(num_width, DiffMarker._num_width(event[1]))))
+        return len(units) >= count
+
+    def _lines(self, index):
+        """Returns rendered lines of a unit"""
+        lines = self._rendered.get(index)
+        if lines is not None:
+            self._rendered.move_to_end(index)
+            return lines
+
+        diff, hunk, num_width = self._units[index]
+        marker = self._marker
+        if hunk is None:
+            lines = list(marker._markup_header(diff))
+            if index > 0 and diff._old_path is not None:
+                lines.insert(0, self._separator)
+        elif marker._side_by_side:
+            lines = list(marker._markup_side_by_side_hunk(
+                hunk, *marker._layout(num_width)))
+        else:
+            lines = list(marker._markup_unified_hunk(hunk))
+        self._rendered[index] = lines
+        if len(self._rendered) > _PAGER_CACHE:
+            self._rendered.popitem(last=False)
+        return lines
+
+    def _screen(self):
+        """Returns rows to show below top of screen, and whether there are
+        more rows after them"""
+        count = self._height - 1    # last row is status line
+        unit, offset = self._top
+        rows = []
+        while self._parse(unit + 1):
+            lines = self._lines(unit)
+            shown = lines[offset:offset + count - len(rows)]
+            rows.extend(shown)
+            if offset + len(shown) < len(lines):
+                return rows, True
+            unit, offset = unit + 1, 0
+            if len(rows) == count:
+                return rows, self._parse(unit + 1)
+        return rows, False
+
+    def _move(self, rows):
+        """Scrolls down by rows, or up if negative, but not beyond the first
+        or last screen"""
+        unit, offset = self._top
+        offset += rows
+        while offset < 0 and unit > 0:
+            unit -= 1
+            offset += len(self._lines(unit))
+        offset = max(offset, 0)
+        if self._parse(unit + 1):
+            while True:
+                length = len(self._lines(unit))
+                if offset < length or not self._parse(unit + 2):
+                    break
+                offset -= length
+                unit += 1
+            offset = min(offset, max(length - 1, 0))
+        self._top = (unit, offset)
+
+        if rows >= 0:
+            shown = len(self._screen()[0])
+            if shown < self._height - 1:
+                self._move(shown - (self._height - 1))
+
+    def _file(self, unit):
+        """Returns index of the file of a unit"""
+        return bisect.bisect_right(self._files, unit) - 1
+
+    def _next_file(self):
+        unit = self._top[0]
+        while self._file(unit) + 1 >= len(self._files):
+            if not self._parse(len(self._units) + 1):
+                return
+        self._top = (self._files[self._file(unit) + 1], 0)
+        self._move(0)
+
+    def _prev_file(self):
+        current = self._file(self._top[0])
+        if current >= 0 and self._top == (self._files[current], 0):
+            current -= 1
+        if current >= 0:
+            self._top = (self._files[current], 0)
+
+    def _bottom(self):
+        while self._parse(len(self._units) + 1):
+            pass
+        if self._units:
+            last = len(self._units) - 1
+            self._top = (last, len(self._lines(last)))
+            self._move(0)
+
+    def command(self, key):
+        """Handles a key press (bytes read from terminal), returns False to
+        quit"""
+        if key in (b'q', b'Q', b'\x03'):
+            return False
+        page = self._height - 1
+        moves = {
+            b'j': 1, b'\r': 1, b'\n': 1, b'\x1b[B': 1, b'\x1bOB': 1,
+            b'k': -1, b'\x1b[A': -1, b'\x1bOA': -1,
+            b' ': page, b'f': page, b'\x06': page, b'\x1b[6~': page,
+            b'b': -page, b'\x02': -page, b'\x1b[5~': -page,
+            b'd': page // 2, b'u': -(page // 2),
+        }
+        if key in moves:
+            self._move(moves[key])
+        elif key in (b'g', b'<', b'\x1b[H', b'\x1bOH', b'\x1b[1~'):
+            self._top = (0, 0)
+        elif key in (b'G', b'>', b'\x1b[F', b'\x1bOF', b'\x1b[4~'):
+            self._bottom()
+        elif key == b'n':
+            self._next_file()
+        elif key in (b'N', b'p'):
+            self._prev_file()
+        elif not key.startswith(b'\x1b') and len(key) > 1:
+            # Keys typed or repeated faster than they are read
+            return all(self.command(key[i:i + 1]) for i in range(len(key)))
+        return True
+
+    def draw(self):
+        """Returns text to draw screen"""
+        rows, more = self._screen()
+        text = ['\x1b[H']
+        for row in rows:
+            text.append(row.replace('\n', '').replace('\r', '') + _RESET +
+                        '\x1b[K\r\n')
+        text.append('\x1b[K\r\n' * (self._height - 1 - len(rows)))
+
+        status = ' (END)' if not more else ''
+        if self._units:
+            diff = self._units[self._top[0]][0]
+            status = ' file %d/%d%s: %s%s' % (
+                self._file(self._top[0]) + 1, len(self._files),
+                '' if self._done else '+',
+                (diff._new_path or '').rstrip().replace('\t', ' '), status)
+        status += '  [q]uit [n/N] next/previous file [g/G] top/bottom'
+        text.append('\x1b[7m' + status[:self._width - 1] + _RESET +
+                    '\x1b[K')
+        return ''.join(text)
+
+    def run(self, tty, out):
+        """Shows pages on out and reads keys from tty until quit"""
+        import selectors
+        import termios
+
+        fd = tty.fileno()
+        saved = termios.tcgetattr(fd)
+        attrs = termios.tcgetattr(fd)
+        attrs[3] &= ~(termios.ICANON | termios.ECHO | termios.ISIG)
+        attrs[6][termios.VMIN], attrs[6][termios.VTIME] = 1, 0
+        wakeup_r, wakeup_w = os.pipe()
+        saved_handler = signal.signal(
+            signal.SIGWINCH, lambda *_: os.write(wakeup_w, b'.'))
+        selector = selectors.DefaultSelector()
+        selector.register(fd, selectors.EVENT_READ)
+        selector.register(wakeup_r, selectors.EVENT_READ)
+        try:
+            termios.tcsetattr(fd, termios.TCSADRAIN, attrs)
+            # Alternate screen, hide cursor, do not wrap long lines
+            out.write(b'\x1b[?1049h\x1b[?25l\x1b[?7l')
+            self.resize(_terminal_width(), _terminal_height())
+            while True:
+                out.write(self.draw().encode('utf-8'))
+                out.flush()
+                for key, _ in selector.select():
+                    if key.fd == wakeup_r:
+                        os.read(wakeup_r, 1024)
+                        self.resize(_terminal_width(), _terminal_height())
+                    elif not self.command(os.read(fd, 32)):
+                        return
+        finally:
+            out.write(b'\x1b[?7h\x1b[?25h\x1b[?1049l')
+            out.flush()
+            termios.tcsetattr(fd, termios.TCSADRAIN, saved)
+            signal.signal(signal.SIGWINCH, saved_handler)
+            selector.close()
+            os.close(wakeup_r)
+            os.close(wakeup_w)
+
+
+def _pipeline_to_pager(stream, parse, render, out, stats=None):
+    """Reads, parses, renders and writes to pager on separate threads.  The
+    parse function takes an iterator of lines and returns an iterable of
+    diffs (or events), the render function takes an iterator of them and
+    returns an iterable of rendered text, which is written to out, a
+    _PagerWriter.  How long each stage was blocked is recorded in stats if
+    given."""
+    pipeline = _Pipeline(stream, [
+        ('read', lambda lines: lines),
+        ('parse', parse),
+        ('render', lambda diffs: render(iter(diffs))),
+    ])
+    writer = ['write', 0.0, 0.0]
+    it = iter(pipeline)
+    try:
+        with contextlib.suppress(BrokenPipeError):
+            while True:
+                start = time.monotonic()
+                try:
+                    data = next(it)
+                except StopIteration:
+                    break
+                finally:
+                    writer[1] += time.monotonic() - start
+                start = time.monotonic()
+                out.write(data)
+                writer[2] += time.monotonic() - start
+            start = time.monotonic()
+            out.flush()
+            writer[2] += time.monotonic() - start
+    finally:
+        pipeline.close()
+
+    if stats:
+        stats.blocked = pipeline.blocked + [writer]
+
+
+def _git_changed_paths(output):
+    """Returns pathspecs of changed files, a renamed or copied file has both
+    paths in one group so that it is diffed as such"""
+    fields = output.split(b'\0')
+    groups, i = [], 0
+    while i + 1 < len(fields):
+        count = 2 if fields[i][:1] in (b'R', b'C') else 1
+        groups.append([':(top)' + os.fsdecode(x)
+                       for x in fields[i + 1:i + 1 + count]])
+        i += 1 + count
+    return groups
+
+
+def _hg_changed_paths(output):
+    return sorted(['relpath:' + os.fsdecode(x)]
+                  for x in output.split(b'\0') if x)
+
+
+def _svn_changed_paths(output):
+    groups = []
+    for line in output.splitlines():
+        path = os.fsdecode(line[8:])    # after status columns
+        if path.startswith('-'):
+            path = os.path.join('.', path)
+        if '@' in path:
+            path += '@'     # or the last '@' is taken as peg revision
+        groups.append([path])
+    return sorted(groups)
+
+
+def _p4_changed_paths(output):
+    groups = []
+    for line in output.splitlines():
+        path = os.fsdecode(line)
+        for char, escaped in (('%', '%25'), ('@', '%40'), ('#', '%23'),
+                              ('*', '%2A')):
+            path = path.replace(char, escaped)
+        groups.append([path])
+    return sorted(groups)
+
+
+# Keys for revision control workspace marker, probe, diff and log (optional)
+# with diff, changed (command to list changed paths) and paths (function to
+# turn its output into groups of path arguments to diff) for --diff-jobs, and
+# path_diff (optional) to diff given paths only
 _VCS_INFO = {
     'Git': {
+        'marker': '.git',
         'probe': ['git', 'rev-parse'],
         'diff': ['git', 'diff', '--no-ext-diff', '--color=never'],
         'log': ['git', 'log', '--patch', '--color=never'],
+        'changed': ['git', 'diff', '--name-status', '-z'],
+        'paths': _git_changed_paths,
     },
     'Mercurial': {
+        'marker': '.hg',
         'probe': ['hg', 'summary'],
         'diff': ['hg', 'diff', '--git', '--noprefix', '--root', '.'],
         'log': ['hg', 'log', '--patch'],
+        'changed': ['hg', 'status', '--modified', '--added', '--removed',
+                    '--deleted', '--no-status', '--print0', '.'],
+        'paths': _hg_changed_paths,
     },
     'Perforce': {
+        'marker': None,     # name of file given by P4CONFIG if set
         'probe': ['p4', 'info'],
         'diff': ['p4', 'diff', '-du'],
         'log': None,
+        'changed': ['p4', 'diff', '-sa'],
+        'paths': _p4_changed_paths,
     },
     'Svn': {
+        'marker': '.svn',
         'probe': ['svn', 'info'],
         'diff': ['svn', 'diff'],
         'log': ['svn', 'log', '--diff', '--use-merge-history'],
+        'changed': ['svn', 'diff', '--summarize'],
+        'paths': _svn_changed_paths,
+        # A changed directory is listed by itself, along with its files
+        'path_diff': ['svn', 'diff', '--depth', 'empty'],
     },
 }
 
 
+_PROBE_TIMEOUT = 3.0     # seconds to wait for probe commands
+
+
 def _revision_control_probe():
-    """Returns version control name (key in _VCS_INFO) or None."""
-    for vcs_name, ops in _VCS_INFO.items():
-        if _check_command_status(ops.get('probe')):
-            return vcs_name
+    """Returns version control name (key in _VCS_INFO) or None.  Looks for
+    workspace markers first, probe commands are only run when that is
+    ambiguous."""
+    found = _workspace_markers(os.getcwd())
+    if len(found) == 1:
+        return found[0]
+    if not found:
+        # Perforce workspace may have no marker file at all, with client set
+        # by `p4 set` or P4ENVIRO
+        found = ['Perforce']
+    return _probe_commands(found)
+
+
+def _workspace_markers(path: str) -> list:
+    """Returns names of version controls which have a workspace marker in
+    path or any of its parents, in order of _VCS_INFO.  GIT_DIR and P4CLIENT
+    in environment count as markers too."""
+    markers = {ops['marker']: name for name, ops in _VCS_INFO.items()
+               if ops['marker']}
+    if os.getenv('P4CONFIG'):
+        markers[os.getenv('P4CONFIG')] = 'Perforce'
+    found = set()
+    if os.getenv('GIT_DIR'):
+        found.add('Git')
+    if os.getenv('P4CLIENT'):
+        found.add('Perforce')
+    while True:
+        found.update(name for marker, name in markers.items()
+                     if os.path.exists(os.path.join(path, marker)))
+        parent = os.path.dirname(path)
+        if parent == path:
+            break
+        path = parent
+    return [name for name in _VCS_INFO if name in found]
+
+
+def _probe_commands(names: list, timeout=_PROBE_TIMEOUT):
+    """Runs probe commands of given version controls in parallel, returns
+    the first name in order whose command returns 0 within timeout, or
+    None."""
+    import subprocess
+
+    procs = []
+    for name in names:
+        try:
+            proc = subprocess.Popen(_VCS_INFO[name]['probe'],
+                                    stdout=subprocess.DEVNULL,
+                                    stderr=subprocess.DEVNULL)
+        except OSError:
+            continue
+        procs.append((name, proc))
+
+    deadline = time.monotonic() + timeout
+    found = None
+    for name, proc in procs:
+        if found is None:
+            try:
+                status = proc.wait(max(deadline - time.monotonic(), 0))
+            except subprocess.TimeoutExpired:
+                status = None
+            if status == 0:
+                found = name
+        if proc.poll() is None:
+            proc.kill()
+            proc.wait()
+    return found
+
+
+class _MappedFile:
+    """Lines of a regular file, read through a memory map.  Line boundaries
+    are searched in chunks of about _MMAP_CHUNK bytes which are split in one
+    go, so there is no per-line work in Python."""
+
+    def __init__(self, fileobj):
+        import mmap
+
+        fd = fileobj.fileno()
+        self._offset = os.lseek(fd, 0, os.SEEK_CUR)
+        self._stat = os.fstat(fd)
+        self._map = mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+
+    def __iter__(self):
+        return self.lines(self._offset, len(self._map))
+
+    def lines(self, start, end):
+        """Returns an iterator of lines from byte offset start to end, which
+        should be at line boundaries"""
+        return itertools.chain.from_iterable(
+            map(_split_lines, self._chunks(start, end)))
+
+    def _chunks(self, start, end):
+        m = self._map
+        while start < end:
+            stop = m.find(b'\n', min(start + _MMAP_CHUNK, end) - 1) + 1 or end
+            yield m[start:stop]
+            start = stop
+
+    def close(self):
+        self._map.close()
+
+
+class _PatchIndex:
+    """Byte offsets of diffs of files and their hunks in a patch file, to
+    read selected ones only.  Diff of a file starts at headers before its
+    paths (e.g. commit message and 'diff --git' line) and ends where diff of
+    next file starts, hunks likewise, the same as with DiffParser.  Diff of a
+    file with no paths (e.g. mode change only) starts at its 'diff --git' or
+    'Index:' line, and an 'Only in' or 'Binary files' line is a diff by
+    itself, so that these can be selected too."""
+
+    def __init__(self, files, end):
+        self.files = files  # [start, new path, [start of each hunk]] per file
+        self.end = end
+
+    @classmethod
+    def scan(cls, lines, offset=0):
+        """Builds index from lines starting at byte offset, only the first
+        bytes of lines are looked at, except hunk meta for number of lines
+        in hunk and lines of diff headers for paths, so nothing is decoded"""
+        hunk_meta = _HUNK_META_RE
+        files = []
+        pending = None      # start of lines not in a hunk since last hunk
+        old_left = new_left = 0
+        new_path = False    # whether next line is new path
+        opened = False      # whether a diff header started a file, no hunk yet
+        for line in lines:
+            attr = line[:1]
+            if old_left > 0 or new_left > 0:
+                if attr == b' ':
+                    old_left -= 1
+                    new_left -= 1
+                elif attr == b'-':
+                    old_left -= 1
+                elif attr == b'+':
+                    new_left -= 1
+                if attr in (b' ', b'-', b'+'):
+                    offset += len(line)
+                    continue
+
+            if line.startswith(b'--- '):
+                # Old path stays for a deleted file, like _diff_paths()
+                path = cls._path(line[4:])
+                if not opened:
+                    files.append([offset if pending is None else pending,
+                                  path, []])
+                elif path != b'/dev/null' or not files[-1][1]:
+                    files[-1][1] = path
+                pending = None
+                opened = False
+                new_path = True
+            elif new_path and line.startswith(b'+++ '):
+                path = cls._path(line[4:])
+                if path != b'/dev/null':
+                    files[-1][1] = path
+            elif files and hunk_meta.match(line):
+                match = hunk_meta.match(line)
+                files[-1][2].append(offset if pending is None else pending)
+                pending = None
+                opened = False
+                old_left = int(match.group(1) or 1)
+                new_left = int(match.group(2) or 1)
+            elif line.startswith((b'diff --git ', b'Index: ')):
+                # Diff of a file may have no paths, e.g. change of mode only
+                files.append([offset if pending is None else pending,
+                              cls._header_path(line), []])
+                pending = None
+                opened = True
+            elif line.startswith(b'Only in ') or (
+                    line.startswith(b'Binary files ') and
+                    line.rstrip().endswith(b' differ')):
+                # A diff by itself, unless binary diff of a file just started
+                if not opened or attr == b'O':
+                    files.append([offset if pending is None else pending,
+                                  cls._header_path(line), []])
+                pending = None
+                opened = False
+            elif line.startswith(b'\\ No newline at end of'):
+                pass
+            elif pending is None and not opened and not (
+                    files and files[-1][2] and attr in (b' ', b'-', b'+') and
+                    line.rstrip() != b'-' * 72):    # svn log separator
+                pending = offset
+            if not line.startswith(b'--- '):
+                new_path = False
+            offset += len(line)
+        return cls(files, offset)
+
+    @staticmethod
+    def _path(octets):
+        """Returns path in a path line after '--- ' or '+++ '"""
+        return octets.rstrip(b'\r\n').split(b'\t')[0]
+
+    @staticmethod
+    def _header_path(line):
+        """Returns path in a diff header line which starts a diff"""
+        line = line.rstrip(b'\r\n')
+        match = (re.match(rb'^diff --git a/.* b/(.*)$', line) or
+                 re.match(rb'^Index: (.*)$', line) or
+                 re.match(rb'^Binary files .* and (.*) differ$', line) or
+                 re.match(rb'^Only in (.*): (.*)$', line))
+        if not match:
+            return b''
+        return b'/'.join(x.rstrip(b'/') for x in match.groups())
+
+    @classmethod
+    def load(cls, mapped):
+        """Returns index of a _MappedFile, built once and then cached until
+        the file changes"""
+        import hashlib
+
+        st = mapped._stat
+        cache = _ModelCache(_INDEX_CACHE_SIZE,
+                            os.path.join(_cache_dir(), 'index'))
+        key = hashlib.sha1(repr((
+            __version__, st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns,
+            mapped._offset)).encode('utf-8')).hexdigest()
+        entry = cache.load(key)
+        if entry is not None:
+            return cls(*entry)
+        index = cls.scan(mapped, mapped._offset)
+        cache.save(key, (index.files, index.end))
+        cache.prune()
+        return index
+
+    def ranges(self, selection):
+        """Yields (start, end) byte ranges of selected files and hunks,
+        selection is a list of (first, last, hunk) as of _file_selection()"""
+        files = self.files
+        for first, last, hunk in selection:
+            last = len(files) if last is None else min(last, len(files))
+            for i in range(first - 1, last):
+                start, _, hunks = files[i]
+                end = files[i + 1][0] if i + 1 < len(files) else self.end
+                if hunk is None:
+                    yield start, end
+                elif hunk <= len(hunks):
+                    yield start, hunks[0]
+                    yield hunks[hunk - 1], (hunks[hunk] if hunk < len(hunks)
+                                            else end)
+
+
+def _file_selection(spec):
+    """Parses --files argument into a list of (first, last, hunk), where
+    numbers count from 1, last is None for no limit, and hunk is None for
+    all hunks"""
+    import argparse
 
+    selection = []
+    for item in spec.split(','):
+        match = re.match(r'^(\d+)(?:(-)(\d*)|:(\d+))?$', item.strip())
+        if not match or int(match.group(1)) < 1 or match.group(4) == '0':
+            raise argparse.ArgumentTypeError('invalid file range: %r' % item)
+        first = int(match.group(1))
+        if match.group(2):
+            last = int(match.group(3)) if match.group(3) else None
+        else:
+            last = first
+        hunk = int(match.group(4)) if match.group(4) else None
+        selection.append((first, last, hunk))
+    return selection
+
+
+def _non_negative_int(value):
+    """Parses an option argument which is an integer not below 0"""
+    import argparse
 
-def _check_command_status(cmd: list) -> bool:
-    """Return True if command returns 0."""
     try:
-        return subprocess.call(
-            cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE) == 0
-    except OSError:
-        return False
+        number = int(value)
+    except ValueError:
+        number = -1
+    if number < 0:
+        raise argparse.ArgumentTypeError(
+            'invalid non-negative int value: %r' % value)
+    return number
+
+
+def _split_lines(chunk):
+    """Splits bytes into lines the way iterating a file object does"""
+    if b'\r' not in chunk:
+        return chunk.splitlines(True)
+    # Unlike file objects, splitlines() also breaks at '\r'
+    lines = [x + b'\n' for x in chunk.split(b'\n')]
+    lines[-1] = lines[-1][:-1]
+    return lines if lines[-1] else lines[:-1]
 
 
 def _decode(octets):
@@ -685,12 +2795,23 @@ def _decode(octets):
 
 
 def _terminal_width():
+    import shutil
+
     try:
         return shutil.get_terminal_size().columns
     except Exception:
         return 80
 
 
+def _terminal_height():
+    import shutil
+
+    try:
+        return shutil.get_terminal_size().lines
+    except Exception:
+        return 24
+
+
 def _trap_interrupts(entry_fn):
     def _entry_wrapper():
         signal.signal(signal.SIGINT, signal.SIG_DFL)
@@ -744,6 +2865,89 @@ def _parse_args():
     parser.add_argument(
         '-o', '--pager-options', metavar='OPT',
         help='options to supply to pager application')
+    parser.add_argument(
+        '--builtin-pager', action='store_true',
+        help='page output in a built-in pager which renders diffs only when '
+             'they are shown, instead of rendering all for pager '
+             'application; keys: j/k line, space/b page, n/N next/previous '
+             'file, g/G top/bottom, q quit')
+    parser.add_argument(
+        '--files', metavar='RANGES', type=_file_selection,
+        help="show only these diffs of files in a patch file on stdin, e.g. "
+             "'3', '2-5,8', '7-', or '3:2' for 2nd hunk of 3rd file; they "
+             "are read by seeking with an index of the patch built once")
+    parser.add_argument(
+        '--list-files', action='store_true',
+        help='list numbered paths of diffs in a patch file on stdin, for '
+             '--files')
+    parser.add_argument(
+        '--include', metavar='GLOB', action='append',
+        help="show only diffs of paths matching GLOB, may be repeated; a glob "
+             "without '/' matches file names, e.g. '*.py'")
+    parser.add_argument(
+        '--exclude', metavar='GLOB', action='append',
+        help="skip diffs of paths matching GLOB without rendering them, may "
+             "be repeated, e.g. 'vendor/*' or '*.lock'")
+    parser.add_argument(
+        '--summarize-skipped', action='store_true',
+        help='show a line for each diff skipped by --include or --exclude')
+    parser.add_argument(
+        '--word-diff', metavar='ENGINE', default='difflib',
+        choices=sorted(_WORD_DIFF_ENGINES),
+        help="engine to find changed words in a changed line, 'difflib' "
+             "(default) or 'myers' which is faster on long lines")
+    parser.add_argument(
+        '--max-intraline-lines', type=int, default=0, metavar='N',
+        help='do not highlight changed words in hunks longer than N lines, '
+             '0 (default) for no limit')
+    parser.add_argument(
+        '--render-budget-ms', type=int, default=0, metavar='MS',
+        help='output raw diff for the rest of hunks once rendering took MS '
+             'milliseconds, 0 (default) for no limit')
+    parser.add_argument(
+        '--jobs', type=_non_negative_int, default=1, metavar='N',
+        help='render diffs in N worker processes, 0 for one per CPU '
+             '(default: 1)')
+    parser.add_argument(
+        '--diff-jobs', type=_non_negative_int, default=1, metavar='N',
+        help='in a workspace, list changed paths first and diff them in N '
+             'parallel commands, 0 for one per CPU (default: 1, a single '
+             'diff command); falls back to a single command if paths or '
+             'revisions are given')
+    parser.add_argument(
+        '--low-latency', action='store_true',
+        help='render each hunk as soon as it is complete instead of each '
+             'file, and show first screen without waiting for more input; '
+             'width of line numbers in side-by-side mode may grow by hunk')
+    parser.add_argument(
+        '--pipeline', action='store_true',
+        help='read, parse, render and page on separate threads')
+    parser.add_argument(
+        '--nonblocking', action='store_true',
+        help='read input from a pipe and write to pager without blocking on '
+             'either, on one thread, rendering in between (Unix only, '
+             'ignored with --pipeline)')
+    parser.add_argument(
+        '--buffer-size', type=int, default=_WRITE_BUFFER, metavar='N',
+        help='write output to pager in chunks of about N bytes, the first '
+             'screen is always written right away (default: %d)'
+             % _WRITE_BUFFER)
+    parser.add_argument(
+        '--cache', action='store_true',
+        help='cache changes found in diffs on disk, so that viewing the same '
+             'diffs again (e.g. at another width or theme) is faster, '
+             'except with --low-latency')
+    parser.add_argument(
+        '--cache-size', type=int, default=_MODEL_CACHE_SIZE, metavar='MB',
+        help='evict least recently used entries once the cache is over MB '
+             'megabytes (default: %d)' % _MODEL_CACHE_SIZE)
+    parser.add_argument(
+        '--stats', action='store_const', const='text',
+        help='print counters and time spent in each phase to stderr on '
+             'exit, also enabled by environment variable YDIFF_STATS=1')
+    parser.add_argument(
+        '--stats-json', action='store_const', const='json', dest='stats',
+        help='same as --stats but in JSON, or set YDIFF_STATS=json')
     themes = ', '.join(sorted(_all_themes().keys()))
     parser.add_argument(
         '--theme', metavar='THEME', default='default',
@@ -754,18 +2958,89 @@ def _parse_args():
     # Place possible options defined in YDIFF_OPTIONS at the beginning of argv
     ydiff_opts = [x for x in os.getenv('YDIFF_OPTIONS', '').split(' ') if x]
     opts, args = parser.parse_known_args(ydiff_opts + sys.argv[1:])
+    if not opts.stats:
+        opts.stats = _stats_from_env(os.getenv('YDIFF_STATS', ''))
     return opts, args
 
 
-def _get_patch_stream(args: list, read_vcs_log: bool):
+def _stats_from_env(value):
+    """Returns stats format enabled by value of YDIFF_STATS, or None"""
+    value = value.strip().lower()
+    if value == 'json':
+        return 'json'
+    if value in ('1', 'true', 'yes', 'on', 'text'):
+        return 'text'
+    return None
+
+
+def _diff_commands(vcs, args, jobs):
+    """Returns diff commands of batches of changed paths in workspace, so that
+    there are enough batches for jobs, or None if changed paths can not be
+    listed, e.g. args has paths or revisions which would be ambiguous when
+    followed by more paths, or options unknown to listing command"""
+    import subprocess
+
+    info = _VCS_INFO[vcs]
+    if any(not x.startswith('-') or x == '--' for x in args):
+        return None
+    try:
+        proc = subprocess.Popen(info['changed'] + args,
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.DEVNULL)
+    except OSError:
+        return None
+    output = proc.communicate()[0]
+    if proc.returncode != 0:
+        return None
+
+    groups = info['paths'](output)
+    size = max(1, min(_DIFF_BATCH, -(-len(groups) // jobs)))
+    cmd = info.get('path_diff', info['diff']) + args
+    return [cmd + sum(groups[i:i + size], [])
+            for i in range(0, len(groups), size)]
+
+
+def _run_command(cmd):
+    import subprocess
+
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+    return proc.communicate()[0]
+
+
+def _parallel_output(cmds, jobs):
+    """Yields output lines of commands run in a pool of threads, in order of
+    cmds.  Like _markup_diffs_parallel(), only a few commands per thread are
+    run ahead, and output of a command is yielded as soon as it and all
+    commands before it are done."""
+    import concurrent.futures
+
+    window, pending = jobs * _JOBS_WINDOW, collections.deque()
+    with concurrent.futures.ThreadPoolExecutor(jobs) as executor:
+        try:
+            for cmd in cmds:
+                pending.append(executor.submit(_run_command, cmd))
+                while pending and (len(pending) >= window or
+                                   pending[0].done()):
+                    yield from _split_lines(pending.popleft().result())
+            while pending:
+                yield from _split_lines(pending.popleft().result())
+        finally:
+            for future in pending:
+                future.cancel()
+
+
+def _get_patch_stream(args: list, read_vcs_log: bool, diff_jobs=1):
     mode = os.fstat(sys.stdin.fileno()).st_mode
+    if stat.S_ISREG(mode):
+        # Empty files can not be mapped
+        with contextlib.suppress(OSError, OverflowError, ValueError):
+            return _MappedFile(sys.stdin)
     if stat.S_ISREG(mode) or stat.S_ISFIFO(mode):
         return getattr(sys.stdin, 'buffer', sys.stdin)
 
     vcs = _revision_control_probe()
     if not vcs:
-        sys.stderr.write('*** Not in a supported workspace, supported are: '
-                         '%s\n' % ', '.join(sorted(_VCS_INFO.keys())))
+        _unsupported_workspace()
         return None
 
     if read_vcs_log:
@@ -775,8 +3050,25 @@ def _get_patch_stream(args: list, read_vcs_log: bool):
             return None
     else:
         cmd = _VCS_INFO[vcs]['diff']
+        if diff_jobs != 1:
+            diff_jobs = diff_jobs or os.cpu_count() or 1
+            cmds = _diff_commands(vcs, args, diff_jobs)
+            if cmds is not None:
+                return _parallel_output(cmds, diff_jobs)
+
+    import subprocess
+
+    try:
+        return subprocess.Popen(cmd + args, stdout=subprocess.PIPE).stdout
+    except OSError:
+        # A workspace marker was found but its tool is not installed
+        _unsupported_workspace()
+        return None
 
-    return subprocess.Popen(cmd + args, stdout=subprocess.PIPE).stdout
+
+def _unsupported_workspace():
+    sys.stderr.write('*** Not in a supported workspace, supported are: '
+                     '%s\n' % ', '.join(sorted(_VCS_INFO.keys())))
 
 
 @_trap_interrupts
@@ -788,20 +3080,37 @@ def _main():
         sys.stderr.write('*** Unknown theme, available are: %s\n' % themes)
         return 1
 
-    stream = _get_patch_stream(args, opts.log)
+    stream = _get_patch_stream(args, opts.log, opts.diff_jobs)
     if stream is None:
         return 1
 
+    patch = stream
+    if opts.files or opts.list_files:
+        if not isinstance(patch, _MappedFile):
+            sys.stderr.write('*** --files and --list-files need a patch file '
+                             'on stdin\n')
+            return 1
+        index = _PatchIndex.load(patch)
+        if opts.list_files:
+            for i, (_, path, _) in enumerate(index.files):
+                sys.stdout.write('%d\t%s' % (i + 1, _decode(path + b'\n')))
+            patch.close()
+            return 0
+        stream = itertools.chain.from_iterable(
+            itertools.starmap(patch.lines, index.ranges(opts.files)))
+
     if opts.color == 'auto' and sys.stdout.isatty() or opts.color == 'always':
-        markup_to_pager(stream, opts)
+        if opts.builtin_pager and sys.stdout.isatty():
+            builtin_pager(stream, opts)
+        else:
+            markup_to_pager(stream, opts)
     else:
         # pipe out stream untouched to make sure it is still a patch
         byte_output = getattr(sys.stdout, 'buffer', sys.stdout)
         for line in stream:
             byte_output.write(line)
 
-    if stream is not None:
-        stream.close()
+    patch.close()
     return 0
 
 